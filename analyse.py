@@ -1,25 +1,21 @@
-import sqlite3
+import os
+import db, stats
 
-DB_PATH = "transcriptions.db"
-conn = sqlite3.connect(DB_PATH)
-c    = conn.cursor()
+DB_PATH = os.getenv("DB_PATH", "new.db")
+conn = db.reader(DB_PATH)  # read-only: ingest maintains the stats tables
 
 n = 10
 
-# 1. Query top n most frequent words
-c.execute(f"""
-    SELECT word, COUNT(*) AS freq
-      FROM clips
-  GROUP BY LOWER(word)
-  ORDER BY freq DESC
-     LIMIT {n};
-""")
-
-topn = c.fetchall()  # list of (word, freq)
+# 1. Top n most frequent words, straight from the materialized counts
+topn = stats.top_words(conn, n)  # list of (word, freq)
 
 # 2. Print ’em out
-print(f"🔥 Top {n} Most Common Words:")
+print(f"🔥 Top {n} Most Common Words:")
 for rank, (word, freq) in enumerate(topn, start=1):
-    print(f"{rank}. “{word.strip().lower()}” — {freq} occurrences")
+    print(f"{rank}. “{word}” — {freq} occurrences")
+
+cov = stats.coverage(conn)
+if cov["share"] is not None:
+    print(f"📚 {cov['available']}/{cov['common']} common English words available ({cov['share']:.1%}).")
 
-conn.close()
\ No newline at end of file
+db.close_all()
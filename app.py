@@ -1,216 +1,537 @@
-from vocabulary import word_index
-import random, threading, os, subprocess as sp, numpy as np
+import vocabulary
+from vocabulary import plan_sentence, DB_PATH, DOWNLOAD_DIR
+import asyncio, hashlib, json, os, random, threading, time
+from collections import OrderedDict
+from contextlib import aclosing
 from hybridoma import App, portal
-from moviepy.editor import VideoFileClip, concatenate_videoclips
-from PIL import Image, ImageDraw, ImageFont
-from moviepy.config import get_setting
+from render import render, prefetch, preload, is_cached, render_settings, pick_profile, output_format, RenderError, RenderCancelled
+from media import MediaTable
+from render_cache import RenderCache, make_key
+from scheduler import RenderScheduler, QueueFull
+import db, metrics, stats
 
 app = App(__name__)
 CHANNEL_NAME = "Zack D. Films"
+scheduler = RenderScheduler(initializer=preload)
+render_cache = RenderCache()
+media_table = MediaTable()
+
+metrics.Gauge(metrics.registry, "zdf_render_queue_depth", "Renders waiting for a worker.", fn=lambda: scheduler.depth)
+metrics.Gauge(metrics.registry, "zdf_renders_running", "Renders currently running.", fn=lambda: scheduler.running)
+
+# Always pick the same clips for the same sentence, so repeat requests hit the render cache.
+STABLE_SELECTION = os.getenv("STABLE_SELECTION", "0") == "1"
+
+# Cut runs of words that were said together in one video as a single clip.
+PHRASE_CLIPS = os.getenv("PHRASE_CLIPS", "1") == "1"
+
+# Clips picked (and warmed) by `prepare` while someone types, per page
+# session: {session: (expires, index generation, {word: selection})}. That
+# session's next create_video uses (and drops) them; unclaimed ones expire.
+PREPARED_SESSIONS = int(os.getenv("PREPARED_SESSIONS", 1024))
+PREPARED_TTL = float(os.getenv("PREPARED_TTL", 300))
+PREPARE_MAX_WORDS = 32
+PREPARE_NICE = int(os.getenv("PREPARE_NICE", 10))
+prepared = OrderedDict()
+_warming = set()  # background prefetch tasks, so they aren't garbage collected mid-run
+
+# How many items of a create_videos batch are handed to the scheduler at once.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", scheduler.workers))
+
+# Importing this module only sets things up. The index, the suggester and
+# the render workers load in a background warm-up, so `/` and /healthz
+# answer straight away and /readyz says when lookups stop having to wait.
+startup = {"state": "starting", "started": time.time(), "ready_in": None, "workers_in": None, "error": None}
+
+
+def _warm_up():
+    began = time.perf_counter()
+    try:
+        if not os.path.exists(DB_PATH):
+            # Most likely a compose deployment that still keeps new.db next
+            # to docker-compose.yml rather than in data/.
+            raise FileNotFoundError(f"{DB_PATH} doesn't exist (with docker compose, move new.db into data/)")
+        gen = vocabulary.current()
+        media_table.load()
+        startup.update(state="ready", ready_in=time.perf_counter() - began)
+        print(f"✅ Ready in {startup['ready_in']:.2f}s (index generation {gen.number}).")
+    except Exception as e:
+        startup.update(state="failed", error=str(e))
+        print(f"⚠️ Warm-up failed: {e}")
+        return
+    try:
+        scheduler.warm()
+        startup["workers_in"] = time.perf_counter() - began
+    except Exception as e:
+        print(f"⚠️ Couldn't start render workers early: {e}")
+
+
+# With `python app.py`, spawned children (render workers, the scheduler's
+# manager) re-import this file as __mp_main__; they mustn't warm up too.
+# Checking for a parent process won't do: hypercorn serves the app itself
+# from a spawned child.
+if __name__ != "__mp_main__":
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+
+async def _generation():
+    """
+    The current index generation. If warm-up hasn't finished yet, it and
+    the media table are loaded off the event loop.
+    """
+    if not media_table.ready():
+        await db.run(media_table.load, db_path=media_table.db_path)
+    if vocabulary.ready():
+        return vocabulary.current()
+    return await asyncio.to_thread(vocabulary.current)
+
+
+def _rng(words, stable):
+    return random.Random(hashlib.sha256(" ".join(words).encode()).digest()) if stable else random
+
+
+def _select(w, index, rng, t, memo=None, count=True):
+    """
+    One occurrence of `w` in `index`, or None. `memo` makes repeats of a
+    word reuse the same clip. Speculative picks pass count=False to stay
+    out of the lookup metrics.
+    """
+    if memo is not None and w in memo:
+        return memo[w]
+    with t.stage("lookup"):
+        # Weighted pick among the word's best-scoring clips. Sources flagged
+        # missing / corrupt at ingest don't count; if that rules out all of
+        # the top ones, fall back to everything that was said.
+        sel = media_table.choose(index.ranked(w), rng, output_format()[:2])
+        if sel is None and w in index:
+            sel = media_table.choose(index[w], rng, output_format()[:2])
+        if count:
+            metrics.words_looked_up.inc(result="missing" if sel is None else "found")
+    if sel is not None:
+        sel = media_table.annotate(sel)
+        if memo is not None:
+            memo[w] = sel
+    return sel
+
+
+def _phrases(words, index, t, count=True):
+    """
+    Runs of `words` that were said back to back in one usable video, as
+    {i: (j, selection)}: one clip for words[i:j], cut at the first word's
+    start and the last word's end in the words table.
+    """
+    if not PHRASE_CLIPS or len(words) < 2:
+        return {}
+    with t.stage("plan"):
+        plan = plan_sentence(words, index, allow_missing=True)
+    runs = {}
+    for i, j, match in plan:
+        if match is None or j - i < 2:
+            continue
+        video_id, start, end = match
+        if not media_table.usable(video_id):
+            continue  # those words get picked one by one instead
+        runs[i] = (j, media_table.annotate({
+            "video_id": video_id,
+            "video_path": os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4"),
+            "start": start,
+            "end": end,
+            "phrase": " ".join(words[i:j]),
+        }))
+        if count:
+            metrics.words_looked_up.inc(j - i, result="phrase")
+    return runs
+
+
+def _pick(words, index, rng, t, memo=None):
+    """
+    The blocking part of `_lookup`: (i, j, selection) steps covering
+    `words`, stopping at the first one that has no usable clip (None).
+    """
+    runs = _phrases(words, index, t)
+    steps = []
+    k = 0
+    while k < len(words):
+        j, sel = runs[k] if k in runs else (k + 1, _select(words[k], index, rng, t, memo))
+        steps.append((k, j, sel))
+        if sel is None:
+            break
+        k = j
+    return steps
+
+
+async def _lookup(words, gen, rng, t, substitute=False, memo=None, item=None):
+    """
+    Picks clips covering `words`, logging progress as it goes. Runs of words
+    said back to back in one video become a single clip; the rest get one
+    clip each. With `substitute`, a missing word is replaced (in `words`
+    too) by its closest spoken alternative; otherwise the lookup stops with
+    an error listing suggestions. Everything comes from one index
+    generation, `gen`. Returns the selections, or None.
+    """
+    tag = {} if item is None else {"item": item}
+    for k, w in enumerate(words):
+        if w in gen.index:
+            continue
+        metrics.words_looked_up.inc(result="missing")
+        with t.stage("suggest"):
+            suggestions = await asyncio.to_thread(gen.suggester.suggest, w)
+        alt = suggestions[0]["word"] if substitute and suggestions else None
+        if alt is None:
+            # e = json.dumps({'error': 'We couldn\'t find the word: ' + w, 'word':w})
+            e = {'error': 'We couldn\'t find the word: ' + w, 'word': w, 'suggestions': suggestions, **tag}
+            # yield f"event: error\ndata: {e}\n\n"
+            await portal.log(event='error', data=e)
+            return None
+        await portal.log(event='progress', data={'step': 'substituted', 'word': w, 'with': alt, **tag})
+        words[k] = alt
+
+    # Planning phrases, picking clips and the media lookups behind them stay off the event loop.
+    steps = await asyncio.to_thread(_pick, words, gen.index, rng, t, memo)
+    selections = []
+    for k, j, sel in steps:
+        if sel is None:
+            # Said, but only in sources that are missing or broken.
+            with t.stage("suggest"):
+                suggestions = await asyncio.to_thread(gen.suggester.suggest, words[k])
+            e = {'error': 'We couldn\'t find the word: ' + words[k], 'word': words[k], 'suggestions': suggestions, **tag}
+            await portal.log(event='error', data=e)
+            return None
+        if item is None:
+            # yield f"event: progress\ndata: {json.dumps({'step':'loaded', 'word': w})}\n\n"
+            for w in words[k:j]:
+                loaded = {'step': 'loaded', 'word': w}
+                if j - k > 1:
+                    loaded['phrase'] = sel['phrase']
+                await portal.log(event='progress', data=loaded)
+        selections.append(sel)
+    return selections
+
+
+def _record(timings, video_bytes, t):
+    metrics.renders.inc(status="ok", mode=timings.get("mode", ""))
+    metrics.render_bytes.inc(len(video_bytes))
+    metrics.ffmpeg_exits.inc(code=timings.get("ffmpeg_exit", 0))
+    metrics.cache_requests.inc(timings.get("clip_hits", 0), cache="clip", result="hit")
+    metrics.cache_requests.inc(timings.get("clip_misses", 0), cache="clip", result="miss")
+    t.add("clip_load", timings.get("clip_open", 0.0))
+    t.add("frame_loop", sum(timings.get(k, 0.0) for k in ("get_frame", "watermark", "pipe_write")))
+    t.add("encode", timings.get("encode", 0.0))
+
 
 @portal.expose
-async def create_video(sentence):
+async def create_video(sentence, stable=None, stream=False, trace=False, profile=None, substitute=False, session=None):
     sentence = sentence.strip().lower().split()
-    clips = []
+    stable = STABLE_SELECTION if stable is None else stable
+    rng = _rng(sentence, stable)
+    t = metrics.Trace()
+
+    # The index generation this request sees, even if a newer one is swapped in meanwhile.
+    gen = await _generation()
+    # Words this session's `prepare` already picked (and warmed) a clip for keep that clip.
+    memo = None if stable else _claim(session, gen)
+    claimed = bool(memo)
+    selections = await _lookup(sentence, gen, rng, t, substitute, memo)
+    if selections is None:
+        return
 
-    for w in sentence:
-        if w not in word_index:
-            # e = json.dumps({'error': 'We couldn\'t find the word: ' + w, 'word':w})
-            e = {'error': 'We couldn\'t find the word: ' + w, 'word':w}
-            # yield f"event: error\ndata: {e}\n\n"
-            await portal.log(event='error', data=e)
-            return
-        sel = random.choice(word_index[w])
-        # yield f"event: progress\ndata: {json.dumps({'step':'loaded', 'word': w})}\n\n"
-        await portal.log(event='progress', data={'step': 'loaded', 'word': w})
-        clips.append(VideoFileClip(sel["video_path"]).subclip(sel["start"], sel["end"]))
-
-    # yield f"event: progress\ndata: {json.dumps({'step':'concatenating'})}\n\n"
-    await portal.log(event='progress', data={'step': 'concatenating'})
-    final = concatenate_videoclips(clips, method="compose")
-    w, h = final.size
-    fps = getattr(final, "fps", 24)
-
-    # yield f"event: progress\ndata: {json.dumps({'step':'rendering'})}\n\n"
-    await portal.log(event='progress', data={'step': 'rendering'})
-    cmd = [
-        get_setting("FFMPEG_BINARY"),
-        "-y",
-
-        "-f", "rawvideo",
-        "-pix_fmt", "rgb24",
-        "-s", f"{w}x{h}",
-        "-r", str(fps),
-        "-i", "pipe:0"
-    ]
-    audio_pipe_read_fd = -1
-    audio_pipe_write_fd = -1
-
-    audio_fps = 44100
-    audio_channels = 2
-    audio_format = "s16le"
-
-    audio_pipe_read_fd, audio_pipe_write_fd = os.pipe()
-
-    cmd.extend([
-        "-f", audio_format,
-        "-ar", str(audio_fps),
-        "-ac", str(audio_channels),
-        "-i", f"pipe:{audio_pipe_read_fd}",
-    ])
-
-    cmd.extend([
-        "-map", "0:v:0",
-        "-map", "1:a:0",
-    ])
-
-    cmd.extend(["-c:a", "aac", "-b:a", "128k"])
-    
-    cmd.extend([
-        "-c:v", "libx264",
-        "-preset", "medium",
-        "-tune", "fastdecode",
-        "-pix_fmt", "yuv420p",
-        "-movflags", "frag_keyframe+empty_moov+faststart",
-        "-f", "mp4",
-        "pipe:1",
-    ])
-
-    pass_fds = [audio_pipe_read_fd]
-    proc = sp.Popen(
-        cmd,
-        stdin=sp.PIPE,
-        stdout=sp.PIPE,
-        stderr=sp.PIPE,
-        pass_fds=pass_fds,
-    )
-
-    video_thread = None
-    audio_thread = None
-    writer_error = None
-
-    def write_video_data():
-        nonlocal writer_error
-        try:
-            buffer_size = 10 * 1024 * 1024
-            current_buffer = b''
-            total_frames = int(final.duration * fps) if final.duration else 0
-
-            if total_frames <= 0:
-                print("Warning: Video duration or FPS is zero or invalid. No frames to write.")
-                raise ValueError("Cannot process video with zero duration or fps.")
-
-            font = ImageFont.truetype("assets/font.ttf", size=20)
-            interval_frames = int(2.5 * fps)
-            x, y = random.randint(0, final.w - 200), random.randint(0, final.h - 50)
-
-            for i in range(total_frames):
-                t = i / fps
-                frame_np = final.get_frame(t)
-                frame_bytes = frame_np.tobytes()
-
-                if i % interval_frames == 0:
-                    x, y = random.randint(0, final.w - 200), random.randint(0, final.h - 50)
-
-                frame_img = Image.fromarray(frame_np)
-                draw = ImageDraw.Draw(frame_img)
-                draw.text((x, y), "zdf.mce.run", font=font, fill=(255, 255, 255, 6))
-                frame_np = np.array(frame_img)
-
-                frame_bytes = frame_np.tobytes()
-                current_buffer += frame_bytes
-                if len(current_buffer) >= buffer_size:
-                    if proc.stdin and not proc.stdin.closed:
-                        proc.stdin.write(current_buffer)
-                    else:
-                        print("Video writer: stdin closed prematurely. Stopping.")
-                        break
-                    current_buffer = b''
-
-            if current_buffer and proc.stdin and not proc.stdin.closed:
-                proc.stdin.write(current_buffer)
+    load = (scheduler.running + scheduler.depth) / scheduler.workers
+    profile = pick_profile(profile, load, sum(s["end"] - s["start"] for s in selections))
+    # If every clip is already decoded in the clip cache, the frames path skips decoding entirely.
+    mode = "frames" if claimed and await asyncio.to_thread(is_cached, selections, profile) else None
+    key = make_key(sentence, selections, render_settings(mode=mode, profile=profile))
+    with t.stage("cache"):
+        video_bytes = await asyncio.to_thread(render_cache.get, key)
+    metrics.cache_requests.inc(cache="render", result="miss" if video_bytes is None else "hit")
+    if video_bytes is not None:
+        done = {"video_bytes": video_bytes, "cached": True, "profile": profile}
+        if trace:
+            done["trace"] = t.as_dict()
+        with t.stage("delivery"):
+            await portal.log(event="done", data=done)
+        t.observe()
+        return None
+
+    timings = {}
+    try:
+        queued_at = time.perf_counter()
+        # aclosing: if delivery fails (client gone), the render is cancelled right away.
+        async with aclosing(scheduler.run(render, selections, stream=stream, mode=mode, profile=profile)) as events:
+            async for event, data in events:
+                # The queue wait ends with the first thing the worker says.
+                if queued_at is not None and not (event == "progress" and data.get("step") == "queued"):
+                    t.add("queue", time.perf_counter() - queued_at)
+                    queued_at = None
+
+                if event == "result":
+                    video_bytes = data
+                elif event == "timings":
+                    timings = data
+                else:
+                    with t.stage("delivery"):
+                        await portal.log(event=event, data=data)
+    except QueueFull as e:
+        metrics.renders.inc(status="rejected", mode="")
+        await portal.log(event="error", data={'msg': 'The server is busy, please try again shortly.', 'detail': str(e)})
+        return
+    except RenderError as e:
+        metrics.renders.inc(status="failed", mode="")
+        if e.code is not None:
+            metrics.ffmpeg_exits.inc(code=e.code)
+        # yield f"event: error\ndata: {json.dumps({'msg':e.msg,'detail':e.detail})}\n\n"
+        await portal.log(event="error", data={'msg': e.msg, 'detail': e.detail})
+        return
 
-        except Exception as e:
-            print(f"ERROR in video writer thread: {e}")
-            import traceback
-            traceback.print_exc()
-            writer_error = e
-        finally:
-            if proc.stdin and not proc.stdin.closed:
-                try:
-                    proc.stdin.close()
-                except OSError as oe:
-                    print(f"Video writer: Warning - error closing stdin: {oe}")
-            else:
-                print("Video writer: stdin already closed before finalization.")
-
-    def write_audio_data():
-        nonlocal writer_error
-        audio_pipe_write_stream = os.fdopen(audio_pipe_write_fd, 'wb')
-        try:
-            chunksize = 4096
-            samples_written = 0
+    _record(timings, video_bytes, t)
 
-            for chunk in final.audio.iter_chunks(chunksize=chunksize, fps=audio_fps, quantize=True, nbytes=2, logger=None):
-                audio_pipe_write_stream.write(chunk)
-                samples_written += len(chunk) // (audio_channels * 2)
-        except Exception as e:
-            print(f"ERROR in audio writer thread: {e}")
-            writer_error = e
-        finally:
-            if audio_pipe_write_stream:
-                audio_pipe_write_stream.close()
-            elif audio_pipe_write_fd != -1:
-                 try:
-                    os.close(audio_pipe_write_fd)
-                 except OSError:
-                    pass
+    with t.stage("cache"):
+        await asyncio.to_thread(render_cache.put, key, video_bytes)
+
+    # b64 = json.dumps({"video_base64": base64.b64encode(video_bytes).decode("ascii")})
+    # yield f"event: done\ndata: {b64}\n\n"
+    # Streamed renders have already been delivered chunk by chunk.
+    done = {"streamed": True} if stream else {"video_bytes": video_bytes}
+    done["profile"] = profile
+    if trace:
+        done["trace"] = {**t.as_dict(), "render": timings}
+    with t.stage("delivery"):
+        await portal.log(event="done", data=done)
+    t.observe()
 
+    # return video_bytes
+    return None
 
-    video_thread = threading.Thread(target=write_video_data)
-    video_thread.start()
 
-    if audio_pipe_read_fd != -1:
-        os.close(audio_pipe_read_fd)
-        audio_pipe_read_fd = -1
+@portal.expose
+async def create_videos(sentences, stable=None, trace=False, profile=None, substitute=False):
+    """
+    Renders a list of sentences in one call. Repeated words share a clip,
+    each source video is opened once to cut every clip the batch needs from
+    it, and up to BATCH_CONCURRENCY items render at a time.
+
+    Every event carries the `item` index it belongs to; a final `batch_done`
+    summarizes the batch.
+    """
+    stable = STABLE_SELECTION if stable is None else stable
+    t = metrics.Trace()
+    memo = {}
+    gen = await _generation()  # one index generation for the whole batch
+    items = {}
+
+    for i, sentence in enumerate(sentences):
+        words = sentence.strip().lower().split()
+        selections = await _lookup(words, gen, _rng(words, stable), t, substitute, memo, item=i)
+        if selections is not None:
+            items[i] = (words, selections)
+
+    # The whole batch shares one profile, so it also shares one clip cache.
+    load = (scheduler.running + scheduler.depth) / scheduler.workers
+    longest = max((sum(s["end"] - s["start"] for s in sels) for _, sels in items.values()), default=0)
+    profile = pick_profile(profile, load, longest)
+    settings = render_settings(mode="frames", profile=profile)
+
+    todo = {}
+    for i, (words, selections) in items.items():
+        key = make_key(words, selections, settings)
+        with t.stage("cache"):
+            video_bytes = await asyncio.to_thread(render_cache.get, key)
+        metrics.cache_requests.inc(cache="render", result="miss" if video_bytes is None else "hit")
+        if video_bytes is None:
+            todo[i] = (key, selections)
+        else:
+            await portal.log(event="done", data={"item": i, "video_bytes": video_bytes, "cached": True, "profile": profile})
+
+    sources = {}
+    for _, selections in todo.values():
+        for sel in selections:
+            sources.setdefault(sel["video_id"], (sel["video_path"], set()))[1].add((sel["start"], sel["end"]))
+
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def job(item, fn, *args, **kwargs):
+        result, timings = None, {}
+        async with limit, aclosing(scheduler.run(fn, *args, **kwargs)) as events:
+            async for event, data in events:
+                if event == "result":
+                    result = data
+                elif event == "timings":
+                    timings = data
+                elif item is not None:
+                    await portal.log(event=event, data={**data, "item": item})
+        return result, timings
+
+    async def cut(video_id, video_path, spans):
+        try:
+            return (await job(None, prefetch, video_id, sorted(spans), video_path, profile=profile))[0]
+        except Exception as e:
+            # The render will try the clips one by one and report the item properly.
+            print(f"⚠️ Prefetch of {video_id} failed: {e}")
+            return 0
 
-    audio_thread = threading.Thread(target=write_audio_data)
-    audio_thread.start()
+    with t.stage("prefetch"):
+        cut_counts = await asyncio.gather(*(cut(v, path, spans) for v, (path, spans) in sources.items()))
 
-    video_thread.join()
-    audio_thread.join()
+    async def render_item(i, key, selections):
+        try:
+            video_bytes, timings = await job(i, render, selections, mode="frames", profile=profile)
+        except QueueFull as e:
+            metrics.renders.inc(status="rejected", mode="")
+            await portal.log(event="error", data={'msg': 'The server is busy, please try again shortly.', 'detail': str(e), 'item': i})
+            return False
+        except RenderError as e:
+            metrics.renders.inc(status="failed", mode="")
+            if e.code is not None:
+                metrics.ffmpeg_exits.inc(code=e.code)
+            await portal.log(event="error", data={'msg': e.msg, 'detail': e.detail, 'item': i})
+            return False
+        except Exception as e:
+            metrics.renders.inc(status="failed", mode="")
+            await portal.log(event="error", data={'msg': 'Failed to cut clips', 'detail': str(e), 'item': i})
+            return False
+
+        _record(timings, video_bytes, t)
+        await asyncio.to_thread(render_cache.put, key, video_bytes)
+        await portal.log(event="done", data={"item": i, "video_bytes": video_bytes, "profile": profile})
+        return True
+
+    with t.stage("render"):
+        ok = await asyncio.gather(*(render_item(i, key, sels) for i, (key, sels) in todo.items()))
+
+    summary = {
+        "items": len(sentences),
+        "rendered": sum(ok),
+        "cached": len(items) - len(todo),
+        "failed": len(sentences) - len(items) + ok.count(False),
+        "sources_opened": sum(1 for n in cut_counts if n),
+        "clips": sum(len(spans) for _, spans in sources.values()),
+        "clips_cut": sum(cut_counts),
+        "profile": profile,
+    }
+    if trace:
+        summary["trace"] = t.as_dict()
+    await portal.log(event="batch_done", data=summary)
+    t.observe()
+    return None
 
-    video_bytes = proc.stdout.read()
-    err_bytes = proc.stderr.read()
-    return_code = proc.wait()
 
-    if proc.stdout: proc.stdout.close()
-    if proc.stderr: proc.stderr.close()
+def _expire():
+    now = time.monotonic()
+    while prepared and (len(prepared) > PREPARED_SESSIONS or next(iter(prepared.values()))[0] < now):
+        prepared.popitem(last=False)
+
+
+def _claim(session, gen):
+    """Takes `session`'s prepared picks, as {word: selection}, if they're from generation `gen`."""
+    _expire()
+    entry = prepared.pop(session, None) if session is not None else None
+    if entry is None or entry[1] != gen.number:
+        return {}
+    return dict(entry[2])
+
+
+def _prepare(words, gen, picks, profile):
+    """
+    The blocking part of `prepare`: flags unknown words, extends `picks`
+    (None: don't pick) and finds what needs warming. Returns (unknown
+    words, selections, selections not cached yet, profile).
+    """
+    t = metrics.Trace()
+    unknown = [{"word": w, "suggestions": gen.suggester.suggest(w)} for w in dict.fromkeys(words) if w not in gen.index]
+    selections = []
+    if picks is not None:
+        for w in words:
+            if w in gen.index:
+                sel = _select(w, gen.index, random, t, picks, count=False)
+                if sel is not None:
+                    selections.append(sel)
+    # Phrase clips don't depend on the random pick, so they're worth warming either way.
+    selections += [sel for _, sel in _phrases(words, gen.index, t, count=False).values()]
+
+    load = (scheduler.running + scheduler.depth) / scheduler.workers
+    profile = pick_profile(profile, load, sum(s["end"] - s["start"] for s in selections))
+    todo = [s for s in selections if not is_cached([s], profile)]
+    return unknown, selections, todo, profile
+
+
+async def _warm(video_id, video_path, spans, profile):
+    try:
+        async with aclosing(scheduler.run_idle(prefetch, video_id, sorted(spans), video_path, profile=profile, nice=PREPARE_NICE)) as events:
+            async for _ in events:
+                pass
+    except (QueueFull, RenderCancelled):
+        pass  # busy with real renders (or one just came in); the render will cut it instead
+    except Exception as e:
+        print(f"⚠️ Warming {video_id} failed: {e}")
 
-    if writer_error:
-        # yield f"event: error\ndata: {json.dumps({'msg':'Data writing error','detail':str(writer_error)})}\n\n"
-        await portal.log(event="error", data={'msg': 'Data writing error', 'detail': str(writer_error)})
-        return
-    
-    err_str = err_bytes.decode(errors='ignore') # Decode stderr
 
-    if return_code != 0:
-        # yield f"event: error\ndata: {json.dumps({'msg':'FFmpeg execution error','detail':err_str})}\n\n"
-        await portal.log(event="error", data={'msg': 'FFmpeg execution error', 'detail': err_str})
-        print("FFmpeg Error Output:\n", err_str)
-        return
+@portal.expose
+async def prepare(partial, profile=None, session=None):
+    """
+    Called (debounced) while the user is still typing. Picks clips for the
+    finished words of `partial` and starts cutting them into the clip cache
+    at low priority, so most of the work is done by the time create_video
+    is called. The picks are kept for `session` (an id the page makes up)
+    only, and its next create_video uses them. Returns the words that were
+    never said, with suggestions.
+    """
+    words = partial.lower().split()
+    if words and not partial[-1:].isspace():
+        words.pop()  # still being typed
+    words = words[:PREPARE_MAX_WORDS]
+    gen = await _generation()
+
+    # Stable picks depend on the whole sentence, so there's nothing to reserve until it's submitted.
+    picks = None
+    if session is not None and not STABLE_SELECTION:
+        _expire()
+        _, number, picks = prepared.pop(session, (None, None, {}))
+        picks = dict(picks) if number == gen.number else {}
+
+    unknown, selections, todo, profile = await asyncio.to_thread(_prepare, words, gen, picks, profile)
+    if picks is not None:
+        # Words deleted since don't keep their picks.
+        prepared[session] = (time.monotonic() + PREPARED_TTL, gen.number, {w: sel for w, sel in picks.items() if w in words})
+
+    sources = {}
+    for sel in todo:
+        sources.setdefault(sel["video_id"], (sel["video_path"], set()))[1].add((sel["start"], sel["end"]))
+    for video_id, (path, spans) in sources.items():
+        task = asyncio.create_task(_warm(video_id, path, spans, profile))
+        _warming.add(task)
+        task.add_done_callback(_warming.discard)
+
+    return {"unknown": unknown, "clips": len(selections), "warming": len(todo)}
 
-    # b64 = json.dumps({"video_base64": base64.b64encode(video_bytes).decode("ascii")})
-    # yield f"event: done\ndata: {b64}\n\n"
-    await portal.log(event="done", data={"video_bytes": video_bytes})
 
-    # return video_bytes
-    return None
+@portal.expose
+async def suggest(word, limit=5):
+    """Spoken words closest to `word`, as [{"word", "count", "distance"}]."""
+    return (await _generation()).suggester.suggest(word.strip().lower(), limit)
 
 
 @app.route("/")
 def index():
     return app.render("index.html")
 
+@app.route("/stats")
+def stats_endpoint():
+    body = json.dumps(stats.summary(db.reader(DB_PATH)))
+    return body, 200, {"Content-Type": "application/json"}
+
+@app.route("/healthz")
+def healthz():
+    # Liveness: the process is up and serving requests.
+    return json.dumps({"alive": True, "uptime": time.time() - startup["started"]}), 200, {"Content-Type": "application/json"}
+
+@app.route("/readyz")
+def readyz():
+    # Readiness: lookups won't wait on the index loading.
+    body = json.dumps({**startup, "workers": scheduler.started})
+    return body, 200 if startup["state"] == "ready" else 503, {"Content-Type": "application/json"}
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=9979)
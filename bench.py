@@ -0,0 +1,298 @@
+"""
+Offline render benchmark.
+
+Builds a synthetic corpus (test pattern + tone MP4s and a matching new.db) in
+a scratch directory, then times search_sentence and the render pipeline over
+sentence-length and concurrency sweeps. Results are written as JSON so runs
+from different versions can be diffed.
+
+    python bench.py --lengths 1 5 20 --concurrency 1 4 --out bench_output.json
+    python bench.py --coldstart --coldstart-target 2
+
+--coldstart instead times fresh processes: importing app, and how long
+until it reports ready (index and suggester loaded), with the index file
+already on disk ("warm") and without it ("cold").
+"""
+import argparse, json, os, platform, random, shutil, subprocess as sp, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+WORDS = (
+    "the a this that is was and but you your it its i we they he she what "
+    "why how when where there here now never always every thing things people "
+    "body brain water food animal world life time day night way made make see "
+    "look happens inside actually really crazy weird real fact"
+).split()
+
+WORD_SECONDS = 0.4
+GAP_SECONDS = 0.1
+
+
+def make_corpus(workdir, videos, words_per_video, size="404x720", fps=30, seed=0):
+    """Writes downloads/*.mp4 and new.db with `words` and `segments` under `workdir`."""
+    import ingest, media, stats
+
+    rng = random.Random(seed)
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(downloads, exist_ok=True)
+    os.makedirs(os.path.join(workdir, "assets"), exist_ok=True)
+    shutil.copy(os.path.join(ROOT, "assets", "font.ttf"), os.path.join(workdir, "assets", "font.ttf"))
+
+    conn = ingest.connect(os.path.join(workdir, "new.db"))
+    c = conn.cursor()
+    for v in range(videos):
+        video_id = f"bench{v:05d}"
+        duration = words_per_video * (WORD_SECONDS + GAP_SECONDS) + GAP_SECONDS
+        sp.run([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc=size={size}:rate={fps}:duration={duration:.2f}",
+            "-f", "lavfi", "-i", f"sine=frequency={220 + 20 * (v % 20)}:sample_rate=44100:duration={duration:.2f}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest",
+            os.path.join(downloads, f"{video_id}.mp4"),
+        ], check=True)
+
+        spoken = [rng.choice(WORDS) for _ in range(words_per_video)]
+        rows = []
+        for k, word in enumerate(spoken):
+            start = GAP_SECONDS + k * (WORD_SECONDS + GAP_SECONDS)
+            rows.append((video_id, word, start, start + WORD_SECONDS))
+        c.executemany("INSERT INTO words (video_id, word, start, end) VALUES (?, ?, ?, ?)", rows)
+        stats.update(c, video_id, rows)
+        for k in range(0, len(rows), 5):
+            seg = rows[k:k + 5]
+            c.execute(
+                "INSERT INTO segments (video_id, segment_text, start, end) VALUES (?, ?, ?, ?)",
+                (video_id, " ".join(r[1] for r in seg), seg[0][2], seg[-1][3])
+            )
+            c.execute(
+                "INSERT INTO segments_fts(rowid, segment_text, video_id, start, end) VALUES (?, ?, ?, ?, ?)",
+                (c.lastrowid, " ".join(r[1] for r in seg), video_id, seg[0][2], seg[-1][3])
+            )
+        c.execute("INSERT OR REPLACE INTO videos (video_id, transcribed_at) VALUES (?, ?)", (video_id, time.time()))
+    conn.commit()
+    for _ in media.refresh(conn, download_dir=downloads):
+        pass
+    conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(latencies):
+    return {
+        "n": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+    }
+
+
+def random_sentence(rng, vocab, length):
+    return " ".join(rng.choice(vocab) for _ in range(length))
+
+
+def bench_search(lengths, reps, rng):
+    import vocabulary
+
+    vocab = list(vocabulary.word_index)
+    results = []
+    for length in lengths:
+        latencies = []
+        for _ in range(reps):
+            sentence = random_sentence(rng, vocab, length)
+            start = time.perf_counter()
+            vocabulary.search_sentence(sentence)
+            latencies.append(time.perf_counter() - start)
+        results.append({"bench": "search_sentence", "words": length, **summarize(latencies)})
+    return results
+
+
+def bench_render(modes, lengths, concurrency, reps, rng):
+    import vocabulary, render
+
+    vocab = list(vocabulary.word_index)
+
+    def one(mode, sentence):
+        selections = [rng.choice(vocabulary.word_index[w]) for w in sentence.split()]
+        timings = {}
+        start = time.perf_counter()
+        render.render(selections, mode=mode, emit=lambda event, data: event == "timings" and timings.update(data))
+        return time.perf_counter() - start, timings
+
+    results = []
+    for mode in modes:
+        for length in lengths:
+            for workers in concurrency:
+                sentences = [random_sentence(rng, vocab, length) for _ in range(reps)]
+                wall = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    runs = list(pool.map(lambda s: one(mode, s), sentences))
+                wall = time.perf_counter() - wall
+
+                latencies = [r[0] for r in runs]
+                frames = sum(r[1].get("frames", 0) for r in runs)
+                stages = {}
+                for _, timings in runs:
+                    for name, value in timings.items():
+                        if isinstance(value, float) and name != "total":
+                            stages[name] = stages.get(name, 0.0) + value / len(runs)
+
+                results.append({
+                    "bench": "render", "mode": mode, "words": length, "concurrency": workers,
+                    **summarize(latencies),
+                    "fps": frames / wall if wall else None,
+                    "renders_per_second": len(runs) / wall if wall else None,
+                    "stages": stages,
+                    "used_mode": sorted({r[1].get("mode") for r in runs}),
+                })
+                r = results[-1]
+                print(f"  {mode:<7} words={length:<3} x{workers:<2} p50={r['p50']:.3f}s p95={r['p95']:.3f}s p99={r['p99']:.3f}s {r['fps']:.0f} fps", file=sys.stderr)
+    return results
+
+
+COLDSTART_SCRIPT = """
+import json, sys, threading, time, multiprocessing as mp
+sys.path.insert(0, {root!r})
+
+def serve(out):
+    began = time.perf_counter()
+    import app
+    imported = time.perf_counter() - began
+    deadline = time.monotonic() + 60
+    while app.startup["state"] == "starting" and time.monotonic() < deadline:
+        time.sleep(0.005)
+    out.put({{"import": imported, "ready": time.perf_counter() - began, "state": app.startup["state"]}})
+    # Let the rest of the warm-up (render workers) finish, then shut them down cleanly.
+    for t in threading.enumerate():
+        if t.name == "warm-up":
+            t.join()
+    app.scheduler.shutdown()
+
+if __name__ == "__main__":
+    # Import app in a spawned child, the way hypercorn serves it (even with one worker).
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    child = ctx.Process(target=serve, args=(out,))
+    child.start()
+    result = out.get()
+    child.join()
+    print(json.dumps(result))
+"""
+
+# Modules app.py must not pull in at import (they belong to the render workers).
+HEAVY_MODULES = ("numpy", "PIL", "moviepy")
+
+
+def bench_coldstart(reps, target):
+    import compact_index
+
+    # A file rather than `-c`, so the spawned child can import `serve` from it.
+    script = os.path.abspath("coldstart.py")
+    with open(script, "w") as f:
+        f.write(COLDSTART_SCRIPT.format(root=ROOT))
+    heavy = [
+        m for m in sp.run(
+            [sys.executable, "-c", f"import sys; sys.path.insert(0, {ROOT!r}); import app; "
+             f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"],
+            stdout=sp.PIPE, text=True, check=True,
+        ).stdout.split()
+    ]
+    results = []
+    for index in ("warm", "cold"):
+        runs, process = [], []
+        for _ in range(reps):
+            if index == "cold" and os.path.exists(compact_index.INDEX_PATH):
+                os.remove(compact_index.INDEX_PATH)
+            start = time.perf_counter()
+            out = sp.run([sys.executable, script], stdout=sp.PIPE, text=True, check=True).stdout
+            process.append(time.perf_counter() - start)
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        ready = summarize([r["ready"] for r in runs])
+        results.append({
+            "bench": "coldstart", "index": index,
+            "import": summarize([r["import"] for r in runs]),
+            "ready": ready,
+            "process": summarize(process),
+            "failed": sum(r["state"] != "ready" for r in runs),
+            "heavy_imports": heavy,
+            "target": target,
+            "ok": ready["p95"] <= target and not heavy,
+        })
+        r = results[-1]
+        print(
+            f"  coldstart index={index:<4} import p50={r['import']['p50']:.3f}s ready p50={ready['p50']:.3f}s "
+            f"p95={ready['p95']:.3f}s (target {target:.2f}s) {'✅' if r['ok'] else '❌'}",
+            file=sys.stderr,
+        )
+    if heavy:
+        print(f"  ⚠️ importing app loaded {', '.join(heavy)}", file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--videos", type=int, default=20)
+    parser.add_argument("--words-per-video", type=int, default=40)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1, 3, 5, 10, 20])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--modes", nargs="+", default=["concat", "frames"])
+    parser.add_argument("--reps", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Reuse / keep the synthetic corpus here instead of a temp dir.")
+    parser.add_argument("--skip-render", action="store_true")
+    parser.add_argument("--coldstart", action="store_true", help="Only run the cold start benchmark.")
+    parser.add_argument("--coldstart-target", type=float, default=float(os.getenv("COLDSTART_TARGET", 2.0)),
+                        help="Seconds (p95) from process start to ready.")
+    parser.add_argument("--out", default=os.path.join(ROOT, "bench_output.json"))
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="zdf-bench-")
+    if not os.path.exists(os.path.join(workdir, "new.db")):
+        print(f"🧪 Generating {args.videos} synthetic videos in {workdir}", file=sys.stderr)
+        make_corpus(workdir, args.videos, args.words_per_video, seed=args.seed)
+
+    # Everything in the app resolves new.db, downloads/ and cache/ relative to the cwd.
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    rng = random.Random(args.seed)
+    try:
+        if args.coldstart:
+            results = bench_coldstart(args.reps, args.coldstart_target)
+        else:
+            results = bench_search(args.lengths, args.reps * 10, rng)
+            for r in results:
+                print(f"  search  words={r['words']:<3} p50={r['p50'] * 1000:.2f}ms p99={r['p99'] * 1000:.2f}ms", file=sys.stderr)
+            if not args.skip_render:
+                results += bench_render(args.modes, args.lengths, args.concurrency, args.reps, rng)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "workdir")},
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"📊 Results written to {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+import os, sqlite3, threading, time, subprocess as sp
+from collections import OrderedDict
+from contextlib import contextmanager
+import db
+
+CACHE_DIR = os.path.join("cache", "clips")
+CACHE_BUDGET = int(os.getenv("CLIP_CACHE_BYTES", 2 * 1024 ** 3))
+
+# Every cached clip is normalized to the same geometry so they can be
+# concatenated without any per-frame compositing.
+CLIP_SIZE = tuple(int(v) for v in os.getenv("CLIP_SIZE", "404x720").split("x"))
+CLIP_FPS = int(os.getenv("CLIP_FPS", 30))
+# Recently used clips stay memory-mapped, so hot words skip the open + mmap.
+CLIP_HANDLES = int(os.getenv("CLIP_HANDLES", 64))
+# Temp files older than this (seconds) were left behind by a crashed cut; rebuild removes them.
+STALE_TMP = 3600
+# Cache hits only bump last_used in memory; it's written out this often (and before evicting).
+TOUCH_INTERVAL = float(os.getenv("CLIP_TOUCH_INTERVAL", 5))
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+# How often a cancellable cut checks whether it should stop (seconds).
+CANCEL_POLL = 0.2
+
+DB_PATH = db.DB_PATH
+DOWNLOAD_DIR = "downloads"
+
+
+class Cancelled(Exception):
+    """A cancellable cut was told to stop; its ffmpeg has been killed and nothing was cached."""
+
+
+def ffmpeg_binary():
+    # moviepy.config finds (or fetches) ffmpeg on import; only pay for that once something gets cut.
+    from moviepy.config import get_setting
+    return get_setting("FFMPEG_BINARY")
+
+
+class CachedClip:
+    """A pre-cut word clip: raw rgb24 frames plus s16le PCM, both memory-mapped."""
+
+    def __init__(self, frames, audio, fps=CLIP_FPS, audio_fps=AUDIO_FPS):
+        self.frames = frames
+        self.audio = audio
+        self.fps = fps
+        self.audio_fps = audio_fps
+
+    @property
+    def duration(self):
+        return len(self.frames) / self.fps
+
+    @property
+    def size(self):
+        return self.frames.shape[2], self.frames.shape[1]
+
+    def to_videoclip(self, audio=True):
+        import numpy as np
+        from moviepy.editor import VideoClip
+        from moviepy.audio.AudioClip import AudioArrayClip
+
+        frames, fps = self.frames, self.fps
+        last = len(frames) - 1
+        clip = VideoClip(lambda t: frames[min(int(t * fps + 1e-6), last)], duration=self.duration)
+        clip = clip.set_fps(fps)
+        if not audio:
+            return clip
+        audio = AudioArrayClip(self.audio.astype(np.float32) / 32768, fps=self.audio_fps)
+        return clip.set_audio(audio.set_duration(self.duration))
+
+
+class ClipCache:
+    """
+    Persistent on-disk cache of normalized word clips keyed by (video_id, start, end).
+
+    Clips are cut from the source Short with a single ffmpeg pass the first
+    time they are requested, and afterwards served straight from disk. The
+    cache is bounded by `budget` bytes and evicts least recently used clips.
+    """
+
+    def __init__(self, root=CACHE_DIR, budget=CACHE_BUDGET, size=CLIP_SIZE, fps=CLIP_FPS, handles=CLIP_HANDLES):
+        self.size = tuple(size)
+        self.fps = fps
+        self.budget = budget
+        self.handles = handles
+        self._handles = OrderedDict()
+        self.root = os.path.join(root, f"{self.size[0]}x{self.size[1]}@{fps}")
+        os.makedirs(self.root, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._touched = {}  # key -> last use not written to the index yet
+        self._flushed = time.monotonic()
+        self._conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30, check_same_thread=False)
+        # Every render worker writes to this index; WAL keeps them from syncing the disk on each commit.
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS clips (
+            key       TEXT PRIMARY KEY,
+            video_id  TEXT NOT NULL,
+            start     REAL NOT NULL,
+            end       REAL NOT NULL,
+            frames    INTEGER NOT NULL,
+            bytes     INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_clips_last_used ON clips(last_used);")
+        self._conn.commit()
+
+    @property
+    def frame_bytes(self):
+        return self.size[0] * self.size[1] * 3
+
+    @staticmethod
+    def key(video_id, start, end):
+        return f"{video_id}_{start:.3f}_{end:.3f}"
+
+    def _paths(self, key):
+        base = os.path.join(self.root, key)
+        return base + ".rgb", base + ".pcm"
+
+    @contextmanager
+    def _locked(self, keys):
+        """
+        Holds the per-key locks for `keys`, taken in sorted order so two
+        callers can't deadlock. A key's lock is only forgotten once nobody
+        holds or waits on it anymore.
+        """
+        keys = sorted(set(keys))
+        with self._lock:
+            entries = [self._key_locks.setdefault(k, [threading.Lock(), 0]) for k in keys]
+            for entry in entries:
+                entry[1] += 1
+        held = []
+        try:
+            for lock, _ in entries:
+                lock.acquire()
+                held.append(lock)
+            yield
+        finally:
+            for lock in held:
+                lock.release()
+            with self._lock:
+                for k, entry in zip(keys, entries):
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self._key_locks[k]
+
+    def _touch(self, key):
+        # Called with self._lock held.
+        self._touched[key] = time.time()
+        if time.monotonic() - self._flushed >= TOUCH_INTERVAL:
+            self._flush()
+
+    def _flush(self):
+        # Called with self._lock held.
+        if self._touched:
+            self._conn.executemany("UPDATE clips SET last_used = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+            self._conn.commit()
+            self._touched.clear()
+        self._flushed = time.monotonic()
+
+    def get(self, video_id, start, end, video_path=None):
+        key = self.key(video_id, start, end)
+        with self._locked([key]):
+            clip = self._load(key)
+            if clip is None:
+                with self._lock:
+                    self.misses += 1
+                self._extract(key, video_path or os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4"), start, end)
+                clip = self._load(key)
+                if clip is None:
+                    raise RuntimeError(f"Cutting {video_id} [{start}-{end}] produced no frames.")
+                nbytes = sum(os.path.getsize(p) for p in self._paths(key))
+                with self._lock:
+                    self._touched.pop(key, None)
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, video_id, start, end, len(clip.frames), nbytes, time.time())
+                    )
+                    self._conn.commit()
+                self.evict()
+            else:
+                with self._lock:
+                    self.hits += 1
+                    self._touch(key)
+        return clip
+
+    def __contains__(self, item):
+        video_id, start, end = item
+        return all(os.path.exists(p) for p in self._paths(self.key(video_id, start, end)))
+
+    def _load(self, key):
+        with self._lock:
+            clip = self._handles.get(key)
+            if clip is not None:
+                self._handles.move_to_end(key)
+                return clip
+
+        video_path, audio_path = self._paths(key)
+        if not (os.path.exists(video_path) and os.path.exists(audio_path)):
+            return None
+        w, h = self.size
+        n = os.path.getsize(video_path) // self.frame_bytes
+        if n == 0:
+            return None
+        import numpy as np
+        frames = np.memmap(video_path, dtype=np.uint8, mode="r", shape=(n, h, w, 3))
+        audio = np.memmap(audio_path, dtype=np.int16, mode="r").reshape(-1, AUDIO_CHANNELS)
+        clip = CachedClip(frames, audio, self.fps, AUDIO_FPS)
+
+        if self.handles:
+            with self._lock:
+                self._handles[key] = clip
+                while len(self._handles) > self.handles:
+                    self._handles.popitem(last=False)
+        return clip
+
+    def _extract(self, key, video_path, start, end):
+        self._extract_many(video_path, [(key, start, end)])
+
+    def _extract_many(self, video_path, spans, nice=0, cancelled=None):
+        """
+        Cuts every (key, start, end) in `spans` out of `video_path` with one
+        ffmpeg run, so the source is opened and decoded only once. A `nice`
+        increment runs that ffmpeg at lower CPU priority. If `cancelled()`
+        turns true meanwhile, ffmpeg is killed and this raises Cancelled.
+        """
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(f"Source video not found: {video_path}")
+
+        w, h = self.size
+        # Only decode the part of the file the spans cover; timestamps restart at `first`.
+        first = min(start for _, start, _ in spans)
+        last = max(max(end, start + 1 / self.fps) for _, start, end in spans)
+        cmd = [
+            ffmpeg_binary(),
+            "-y", "-loglevel", "error",
+            "-ss", f"{first:.3f}",
+            "-t", f"{last - first:.3f}",
+            "-i", video_path,
+        ]
+        outputs = []
+        for key, start, end in spans:
+            # Never produce an empty clip for very short words.
+            duration = max(end - start, 1 / self.fps)
+            video_out, audio_out = self._paths(key)
+            # Render workers, batch prefetch and idle warming are separate
+            # processes that may cut the same clip at once; each writes its own.
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            tmp_video, tmp_audio = video_out + suffix, audio_out + suffix
+            outputs.append((tmp_video, tmp_audio, video_out, audio_out))
+            cmd.extend([
+                "-map", "0:v:0",
+                "-vf", (
+                    f"trim=start={start - first:.3f}:duration={duration:.3f},setpts=PTS-STARTPTS,"
+                    f"scale={w}:{h}:force_original_aspect_ratio=decrease,"
+                    f"pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={self.fps}"
+                ),
+                "-f", "rawvideo", "-pix_fmt", "rgb24", tmp_video,
+
+                "-map", "0:a:0",
+                "-af", f"atrim=start={start - first:.3f}:duration={duration:.3f},asetpts=PTS-STARTPTS",
+                "-f", "s16le", "-ar", str(AUDIO_FPS), "-ac", str(AUDIO_CHANNELS), tmp_audio,
+            ])
+
+        proc = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE, preexec_fn=(lambda: os.nice(nice)) if nice else None)
+        while True:
+            try:
+                _, stderr = proc.communicate(timeout=CANCEL_POLL if cancelled else None)
+                break
+            except sp.TimeoutExpired:
+                if cancelled():
+                    proc.kill()
+                    proc.wait()
+                    proc.stderr.close()
+                    self._discard(outputs)
+                    raise Cancelled(f"Cutting {video_path} was cancelled.")
+        if proc.returncode != 0:
+            self._discard(outputs)
+            if all(os.path.exists(p) for paths in outputs for p in paths[2:]):
+                return  # another process published them meanwhile
+            spans_str = ", ".join(f"{start}-{end}" for _, start, end in spans)
+            raise RuntimeError(f"Failed to cut {video_path} [{spans_str}]: {stderr.decode(errors='ignore')}")
+
+        for tmp_video, tmp_audio, video_out, audio_out in outputs:
+            # Pad / trim the PCM so audio and video durations match exactly.
+            frames = os.path.getsize(tmp_video) // self.frame_bytes
+            want = int(round(frames / self.fps * AUDIO_FPS)) * AUDIO_CHANNELS * 2
+            with open(tmp_audio, "r+b") as f:
+                have = f.seek(0, os.SEEK_END)
+                if have < want:
+                    f.write(b"\0" * (want - have))
+                else:
+                    f.truncate(want)
+
+            os.replace(tmp_audio, audio_out)
+            os.replace(tmp_video, video_out)
+
+    @staticmethod
+    def _discard(outputs):
+        # A failed or killed cut's temp files, (tmp_video, tmp_audio, ...) per clip.
+        for paths in outputs:
+            for p in paths[:2]:
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def prefetch(self, video_id, spans, video_path=None, nice=0, cancelled=None):
+        """
+        Makes sure every (start, end) in `spans` from one source is cached,
+        cutting all the missing ones in a single pass over the file.
+        Returns how many clips had to be cut. `cancelled` is passed on to
+        the cut (see _extract_many).
+        """
+        keys = {self.key(video_id, start, end): (start, end) for start, end in spans}
+        with self._locked(keys):
+            missing = [(k, s, e) for k, (s, e) in keys.items() if self._load(k) is None]
+            with self._lock:
+                self.hits += len(keys) - len(missing)
+                self.misses += len(missing)
+            if missing:
+                self._extract_many(video_path or os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4"), missing, nice, cancelled)
+            now = time.time()
+            rows = []
+            for k, (s, e) in keys.items():
+                nbytes = sum(os.path.getsize(p) for p in self._paths(k))
+                frames = os.path.getsize(self._paths(k)[0]) // self.frame_bytes
+                rows.append((k, video_id, s, e, frames, nbytes, now))
+            with self._lock:
+                for k in keys:
+                    self._touched.pop(k, None)
+                self._conn.executemany("INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self._conn.commit()
+        if missing:
+            self.evict()
+        return len(missing)
+
+    def _remove(self, key):
+        with self._lock:
+            self._handles.pop(key, None)
+        for p in self._paths(key):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        with self._lock:
+            self._flush()  # so recently used clips aren't the ones evicted
+            total, = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM clips").fetchone()
+            if total <= self.budget:
+                return
+            victims = []
+            for key, nbytes in self._conn.execute("SELECT key, bytes FROM clips ORDER BY last_used"):
+                if total <= self.budget:
+                    break
+                victims.append(key)
+                total -= nbytes
+            self._conn.executemany("DELETE FROM clips WHERE key = ?", [(k,) for k in victims])
+            self._conn.commit()
+        for key in victims:
+            self._remove(key)
+
+    def rebuild(self, db_path=DB_PATH):
+        """
+        Re-syncs the cache with `new.db`: drops clips from videos that are no
+        longer transcribed, and files that aren't tracked by the index.
+        Clips are matched by video rather than by word, since cuts may be
+        snapped to keyframes and don't always line up with a word row.
+        """
+        valid = {v for v, in db.query("SELECT DISTINCT video_id FROM words", db_path=db_path)}
+
+        with self._lock:
+            clips = self._conn.execute("SELECT key, video_id FROM clips").fetchall()
+            known = {k for k, _ in clips}
+            stale = {k for k, v in clips if v not in valid}
+            self._conn.executemany("DELETE FROM clips WHERE key = ?", [(k,) for k in stale])
+            self._conn.commit()
+        for key in stale:
+            self._remove(key)
+
+        for file in os.listdir(self.root):
+            key, ext = os.path.splitext(file)
+            path = os.path.join(self.root, file)
+            if ext == ".tmp":
+                # `<key>.rgb.<pid>.<thread>.tmp`: a clip being cut right now, unless it was left behind long ago.
+                try:
+                    if time.time() - os.path.getmtime(path) > STALE_TMP:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass  # published or cleaned up meanwhile
+            elif ext in (".rgb", ".pcm") and key not in (known - stale):
+                os.remove(path)
+        return len(stale)
+
+    def warm(self, db_path=DB_PATH, limit=1000):
+        """Pre-cuts one occurrence of each of the `limit` most common words."""
+        rows = db.query("""
+            SELECT video_id, start, end FROM words
+             WHERE id IN (SELECT MIN(id) FROM words GROUP BY LOWER(word) ORDER BY COUNT(*) DESC LIMIT ?)
+        """, (limit,), db_path=db_path)
+        for video_id, start, end in rows:
+            try:
+                self.get(video_id, start, end)
+            except (FileNotFoundError, RuntimeError) as e:
+                print(f"⚠️ {e}")
+        return len(rows)
+
+    def clear(self):
+        with self._lock:
+            keys = [k for k, in self._conn.execute("SELECT key FROM clips")]
+            self._conn.execute("DELETE FROM clips")
+            self._conn.commit()
+        for key in keys:
+            self._remove(key)
+
+
+_caches = {}
+
+def get_cache(size=CLIP_SIZE, fps=CLIP_FPS):
+    """The shared cache for clips normalized to `size` at `fps`."""
+    key = (tuple(size), fps)
+    if key not in _caches:
+        _caches[key] = ClipCache(size=size, fps=fps)
+    return _caches[key]
+
+
+if __name__ == "__main__":
+    import sys
+
+    cache = get_cache()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "rebuild"
+    if cmd == "rebuild":
+        print(f"🧹 Removed {cache.rebuild()} stale clips.")
+    elif cmd == "warm":
+        print(f"🔥 Warmed {cache.warm(limit=int(sys.argv[2]) if len(sys.argv) > 2 else 1000)} clips.")
+    elif cmd == "clear":
+        cache.clear()
+        print("🗑️ Cache cleared.")
+    else:
+        print("Usage: python clip_cache.py [rebuild | warm N | clear]")
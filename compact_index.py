@@ -0,0 +1,444 @@
+import heapq, json, mmap, os, sqlite3, struct
+import db, quality
+from bisect import bisect_left
+from collections.abc import Mapping
+from itertools import chain, groupby
+
+DB_PATH = os.getenv("DB_PATH", "new.db")
+INDEX_PATH = os.path.join("cache", "word_index.bin")
+DOWNLOAD_DIR = "downloads"
+
+MAGIC = b"ZDFIDX\0\0"
+VERSION = 4
+
+# magic, version, n_words, n_videos, n_occ, the index_log generation it was
+# built at, then the byte offset of each section
+HEADER = struct.Struct("<8sIIIIQ13Q")
+SECTIONS = (
+    "word_offsets",   # u32[n_words + 1] into word_blob
+    "word_blob",      # utf-8, words sorted
+    "video_offsets",  # u32[n_videos + 1] into video_blob
+    "video_blob",     # utf-8 video ids
+    "occ_offsets",    # u32[n_words + 1] into the occurrence columns
+    "occ_video",      # u32[n_occ] video index
+    "occ_times",      # f64[n_occ * 2] (start, end) pairs
+    # Positional data: every occurrence also has a position in the corpus,
+    # which is all videos' words laid end to end in spoken order.
+    "occ_pos",        # u32[n_occ] occurrence -> position
+    "pos_occ",        # u32[n_occ] position -> occurrence
+    "tokens",         # u32[n_occ] word id at each position
+    "gaps",           # f32[n_occ * 2] silence before / after the word at each position
+    "occ_score",      # f32[n_occ] quality.score of each occurrence
+    "occ_rank",       # u32[n_occ] each word's occurrences, best score first
+)
+
+MAX_GAP = 1.0  # silence margins are capped, anything past this is "clean enough"
+
+
+def _pack_strings(strings):
+    offsets, blob, pos = [0], bytearray(), 0
+    for s in strings:
+        b = s.encode("utf-8")
+        blob += b
+        pos += len(b)
+        offsets.append(pos)
+    return struct.pack(f"<{len(offsets)}I", *offsets), bytes(blob)
+
+
+def generation(conn):
+    """The newest generation ingest has published to `conn`'s database (see ingest.write_batch)."""
+    try:
+        return conn.execute("SELECT COALESCE(MAX(generation), 0) FROM index_log").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0  # pre-generation database
+
+
+def _read(conn, since=None):
+    """
+    (generation, video ids, word rows) from one consistent snapshot: every
+    video's words, or with `since` only those of videos (re)ingested after
+    that generation.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(words)")}
+    features = ", ".join(f"w.{c}" if c in columns else "NULL" for c in ("probability", "rms"))
+    try:
+        conn.execute("SELECT 1 FROM media LIMIT 1")
+        height, join = "m.height", "LEFT JOIN media m ON m.video_id = w.video_id"
+    except sqlite3.OperationalError:
+        height, join = "NULL", ""  # pre-media database
+
+    conn.execute("BEGIN")  # a read transaction, so the generation matches the rows
+    try:
+        gen = generation(conn)
+        video_ids, where, params = None, "", ()
+        if since is not None:
+            video_ids = [v for v, in conn.execute(
+                "SELECT DISTINCT video_id FROM index_log WHERE generation > ?", (since,)
+            )]
+            where, params = "WHERE w.video_id IN (SELECT value FROM json_each(?))", (json.dumps(video_ids),)
+        rows = conn.execute(f"""
+            SELECT w.video_id, w.word, w.start, w.end, {features}, {height}
+            FROM words w {join} {where} ORDER BY w.video_id, w.start, w.id
+        """, params).fetchall()
+    finally:
+        conn.execute("ROLLBACK")
+    return gen, video_ids, rows
+
+
+def _encode(rows, gen):
+    """The index file's bytes for `rows` (see _read)."""
+
+    videos = {}
+    by_word = {}
+    gaps = []
+    for pos, (video_id, word, start, end, probability, rms, height) in enumerate(rows):
+        video_idx = videos.setdefault(video_id, len(videos))
+
+        prev_end = rows[pos - 1][3] if pos > 0 and rows[pos - 1][0] == video_id else 0.0
+        next_start = rows[pos + 1][2] if pos + 1 < len(rows) and rows[pos + 1][0] == video_id else end + MAX_GAP
+        lead, trail = min(max(start - prev_end, 0.0), MAX_GAP), min(max(next_start - end, 0.0), MAX_GAP)
+        gaps.extend((lead, trail))
+
+        score = quality.score(probability, end - start, lead, trail, rms, height)
+        by_word.setdefault(word.strip().lower(), []).append((video_idx, start, end, pos, score))
+
+    words = sorted(by_word)
+    occ_offsets, occ_video, occ_times, occ_pos, occ_score, occ_rank = [0], [], [], [], [], []
+    pos_occ, tokens = [0] * len(rows), [0] * len(rows)
+    for word_id, word in enumerate(words):
+        first = len(occ_video)
+        for video_idx, start, end, pos, score in by_word[word]:
+            pos_occ[pos] = len(occ_video)
+            tokens[pos] = word_id
+            occ_pos.append(pos)
+            occ_video.append(video_idx)
+            occ_times.extend((start, end))
+            occ_score.append(score)
+        occ_rank.extend(sorted(range(first, len(occ_video)), key=lambda j: -occ_score[j]))
+        occ_offsets.append(len(occ_video))
+
+    word_offsets, word_blob = _pack_strings(words)
+    video_offsets, video_blob = _pack_strings(videos)
+    sections = [
+        word_offsets, word_blob, video_offsets, video_blob,
+        struct.pack(f"<{len(occ_offsets)}I", *occ_offsets),
+        struct.pack(f"<{len(occ_video)}I", *occ_video),
+        struct.pack(f"<{len(occ_times)}d", *occ_times),
+        struct.pack(f"<{len(occ_pos)}I", *occ_pos),
+        struct.pack(f"<{len(pos_occ)}I", *pos_occ),
+        struct.pack(f"<{len(tokens)}I", *tokens),
+        struct.pack(f"<{len(gaps)}f", *gaps),
+        struct.pack(f"<{len(occ_score)}f", *occ_score),
+        struct.pack(f"<{len(occ_rank)}I", *occ_rank),
+    ]
+
+    positions, pos = [], HEADER.size
+    for data in sections:
+        pos += -pos % 8  # keep every section 8-byte aligned for memoryview casts
+        positions.append(pos)
+        pos += len(data)
+
+    out = bytearray(HEADER.pack(MAGIC, VERSION, len(words), len(videos), len(occ_video), gen, *positions))
+    for offset, data in zip(positions, sections):
+        out += b"\0" * (offset - len(out))
+        out += data
+    return bytes(out)
+
+
+def build(db_path=DB_PATH, path=INDEX_PATH):
+    """Builds the binary word index from the `words` table of `db_path`, and publishes it at `path`."""
+    gen, _, rows = _read(db.reader(db_path))
+    data = _encode(rows, gen)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return path
+
+
+def build_delta(db_path=DB_PATH, since=0):
+    """An in-memory WordIndex of just the videos (re)ingested after generation `since`."""
+    gen, _, rows = _read(db.reader(db_path), since)
+    return WordIndex(data=_encode(rows, gen))
+
+
+def peek(path=INDEX_PATH):
+    """The generation of the index file at `path`, or -1 if there isn't a usable one."""
+    try:
+        with open(path, "rb") as f:
+            magic, version, *_, gen = HEADER.unpack(f.read(HEADER.size))[:6]
+    except (OSError, struct.error):
+        return -1
+    return gen if magic == MAGIC and version == VERSION else -1
+
+
+class WordIndex(Mapping):
+    """
+    Read-only, memory-mapped word -> occurrences index.
+
+    Behaves like the old `defaultdict(list)`: `word_index[w]` is a list of
+    {'video_id', 'video_path', 'start', 'end', 'score'} dicts, built on access. The
+    underlying pages are shared by every process that maps the same file.
+    Delta layers (build_delta) hold the same layout in memory instead.
+
+    Methods that take `skip` leave out occurrences from those video indices.
+    """
+
+    def __init__(self, path=INDEX_PATH, data=None):
+        self.path = path if data is None else None
+        if data is None:
+            with open(path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = data
+        magic, version, self.n_words, self.n_videos, self.n_occ, self.generation, *positions = HEADER.unpack_from(self._mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} word index.")
+        self._video_idx = None
+
+        buf = memoryview(self._mm)
+        ends = positions[1:] + [len(self._mm)]
+        sec = {name: buf[start:end] for name, start, end in zip(SECTIONS, positions, ends)}
+        self._word_offsets = sec["word_offsets"][:4 * (self.n_words + 1)].cast("I")
+        self._word_blob = sec["word_blob"]
+        self._video_offsets = sec["video_offsets"][:4 * (self.n_videos + 1)].cast("I")
+        self._video_blob = sec["video_blob"]
+        self._occ_offsets = sec["occ_offsets"][:4 * (self.n_words + 1)].cast("I")
+        self._occ_video = sec["occ_video"][:4 * self.n_occ].cast("I")
+        self._occ_times = sec["occ_times"][:16 * self.n_occ].cast("d")
+        self._occ_pos = sec["occ_pos"][:4 * self.n_occ].cast("I")
+        self._pos_occ = sec["pos_occ"][:4 * self.n_occ].cast("I")
+        self._tokens = sec["tokens"][:4 * self.n_occ].cast("I")
+        self._gaps = sec["gaps"][:8 * self.n_occ].cast("f")
+        self._occ_score = sec["occ_score"][:4 * self.n_occ].cast("f")
+        self._occ_rank = sec["occ_rank"][:4 * self.n_occ].cast("I")
+
+    def _word(self, i):
+        return bytes(self._word_blob[self._word_offsets[i]:self._word_offsets[i + 1]]).decode("utf-8")
+
+    def video_id(self, i):
+        return bytes(self._video_blob[self._video_offsets[i]:self._video_offsets[i + 1]]).decode("utf-8")
+
+    def video_ids(self):
+        return [self.video_id(i) for i in range(self.n_videos)]
+
+    def video_index(self, video_id):
+        """The index of `video_id` in this file, or None."""
+        if self._video_idx is None:
+            self._video_idx = {v: i for i, v in enumerate(self.video_ids())}
+        return self._video_idx.get(video_id)
+
+    @property
+    def layers(self):
+        """(index, skipped video indices) pairs to search, see LayeredIndex."""
+        return [(self, frozenset())]
+
+    def word_id(self, word):
+        """Returns the interned id of `word`, or None if it was never said."""
+        i = bisect_left(_WordView(self), word)
+        if i < self.n_words and self._word(i) == word:
+            return i
+        return None
+
+    def occurrences(self, word_id):
+        """Yields (video_idx, start, end) for every occurrence of `word_id`."""
+        for j in range(self._occ_offsets[word_id], self._occ_offsets[word_id + 1]):
+            yield self._occ_video[j], self._occ_times[2 * j], self._occ_times[2 * j + 1]
+
+    def positions(self, word_id):
+        """Corpus positions at which `word_id` was said."""
+        return self._occ_pos[self._occ_offsets[word_id]:self._occ_offsets[word_id + 1]]
+
+    def extends(self, pos, offset, word_id):
+        """True if `word_id` is said `offset` words after `pos`, in the same video."""
+        nxt = pos + offset
+        return (
+            nxt < self.n_occ
+            and self._tokens[nxt] == word_id
+            and self._occ_video[self._pos_occ[nxt]] == self._occ_video[self._pos_occ[pos]]
+        )
+
+    def video_at(self, pos):
+        """The video index of the word at corpus position `pos`."""
+        return self._occ_video[self._pos_occ[pos]]
+
+    def video_words(self, video_idx):
+        """The distinct words said in video `video_idx`."""
+        # Videos are numbered in the order they're laid out, so theirs is one run of positions.
+        lo = bisect_left(range(self.n_occ), video_idx, key=self.video_at)
+        hi = bisect_left(range(self.n_occ), video_idx + 1, key=self.video_at)
+        return {self._word(self._tokens[pos]) for pos in range(lo, hi)}
+
+    def span(self, pos, length):
+        """(video_idx, start, end) of the `length` words starting at `pos`."""
+        first, last = self._pos_occ[pos], self._pos_occ[pos + length - 1]
+        return self._occ_video[first], self._occ_times[2 * first], self._occ_times[2 * last + 1]
+
+    def cut_quality(self, pos, length):
+        """How cleanly the run can be cut out: the smaller of its leading and trailing silence."""
+        return min(self._gaps[2 * pos], self._gaps[2 * (pos + length - 1) + 1])
+
+    def _entry(self, j):
+        video_id = self.video_id(self._occ_video[j])
+        return {
+            "video_id":    video_id,
+            "video_path": os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4"),
+            "start":       self._occ_times[2 * j],
+            "end":         self._occ_times[2 * j + 1],
+            "score":       self._occ_score[j],
+        }
+
+    def ranked(self, word, k=quality.TOP_K, skip=()):
+        """The `k` best-scoring occurrences of `word`, best first. Empty if it was never said."""
+        i = self.word_id(word)
+        if i is None:
+            return []
+        lo, hi = self._occ_offsets[i], self._occ_offsets[i + 1]
+        if not skip:
+            return [self._entry(j) for j in self._occ_rank[lo:min(hi, lo + k)]]
+        ranked = (j for j in self._occ_rank[lo:hi] if self._occ_video[j] not in skip)
+        return [self._entry(j) for _, j in zip(range(k), ranked)]
+
+    def entries(self, word, skip=()):
+        i = self.word_id(word)
+        if i is None:
+            return []
+        return [
+            self._entry(j) for j in range(self._occ_offsets[i], self._occ_offsets[i + 1])
+            if not skip or self._occ_video[j] not in skip
+        ]
+
+    def count(self, word, skip=()):
+        i = self.word_id(word)
+        if i is None:
+            return 0
+        if skip:
+            return sum(1 for v in self._occ_video[self._occ_offsets[i]:self._occ_offsets[i + 1]] if v not in skip)
+        return self._occ_offsets[i + 1] - self._occ_offsets[i]
+
+    def __getitem__(self, word):
+        i = self.word_id(word) if isinstance(word, str) else None
+        if i is None:
+            raise KeyError(word)
+        return self.entries(word)
+
+    def __contains__(self, word):
+        return isinstance(word, str) and self.word_id(word) is not None
+
+    def __iter__(self):
+        return (self._word(i) for i in range(self.n_words))
+
+    def __len__(self):
+        return self.n_words
+
+
+class _WordView:
+    # Lets bisect run over the mapped word list without decoding all of it.
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.n_words
+
+    def __getitem__(self, i):
+        return self.index._word(i)
+
+
+def _live_words(layer, skip):
+    # A layer's words that only occur in videos a newer layer replaced aren't said anymore.
+    return (w for w in layer if not skip or layer.count(w, skip))
+
+
+class LayeredIndex(Mapping):
+    """
+    One generation of the index: a mapped base file plus in-memory delta
+    layers for the videos ingested since it was built, oldest first. A video
+    that was re-ingested is only read from the newest layer that has it.
+
+    Same interface as WordIndex, minus the positional methods; plan_sentence
+    walks `layers` for those. Immutable, so a lookup can hold on to one while
+    a newer generation is swapped in.
+    """
+
+    def __init__(self, base, deltas=()):
+        self.base = base
+        self.deltas = tuple(deltas)
+        self.generation = (self.deltas[-1] if self.deltas else base).generation
+        self._len = None
+        self.layers = []
+        newer = set()
+        for layer in reversed((base, *self.deltas)):
+            skip = frozenset(i for i in map(layer.video_index, newer) if i is not None) if newer else frozenset()
+            self.layers.append((layer, skip))
+            newer.update(layer.video_ids())
+        self.layers.reverse()
+
+    def extend(self, delta):
+        return LayeredIndex(self.base, (*self.deltas, delta))
+
+    def changed_words(self, older):
+        """
+        The words whose occurrences differ from those in `older`, an earlier
+        generation this one extends: everything its newer layers say, and
+        what was said in the videos those layers replaced.
+        """
+        changed = set()
+        for layer, _ in self.layers[len(older.layers):]:
+            changed.update(layer)
+        for (layer, skip), (_, skipped) in zip(self.layers, older.layers):
+            for video_idx in skip - skipped:
+                changed |= layer.video_words(video_idx)
+        return changed
+
+    def ranked(self, word, k=quality.TOP_K):
+        found = chain.from_iterable(layer.ranked(word, k, skip) for layer, skip in self.layers)
+        return heapq.nlargest(k, found, key=lambda e: e["score"])
+
+    def count(self, word):
+        return sum(layer.count(word, skip) for layer, skip in self.layers)
+
+    def __getitem__(self, word):
+        found = [e for layer, skip in self.layers for e in layer.entries(word, skip)] if isinstance(word, str) else []
+        if not found:
+            raise KeyError(word)
+        return found
+
+    def __contains__(self, word):
+        return isinstance(word, str) and self.count(word) > 0
+
+    def __iter__(self):
+        if not self.deltas:
+            return iter(self.base)
+        return (w for w, _ in groupby(heapq.merge(*(_live_words(layer, skip) for layer, skip in self.layers))))
+
+    def __len__(self):
+        if self.deltas and self._len is None:
+            self._len = sum(1 for _ in self)  # a full merge of every layer, so only once
+        return self.base.n_words if not self.deltas else self._len
+
+    def __bool__(self):
+        # Mapping would fall back on __len__; the first merged word is enough.
+        return next(iter(self), None) is not None
+
+
+def load(db_path=DB_PATH, path=INDEX_PATH):
+    """
+    Maps the index at `path` (building it first if there's no usable one)
+    and layers whatever was ingested since on top, so a stale file costs a
+    small delta instead of a full rebuild.
+    """
+    try:
+        base = WordIndex(path)
+    except (OSError, ValueError):
+        # Missing, or written by an older version of this module.
+        base = WordIndex(build(db_path, path))
+    index = LayeredIndex(base)
+    if generation(db.reader(db_path)) > index.generation:
+        index = index.extend(build_delta(db_path, index.generation))
+    return index
+
+
+if __name__ == "__main__":
+    index = WordIndex(build())
+    print(f"📦 Indexed {index.n_occ} occurrences of {index.n_words} words across {index.n_videos} videos.")
@@ -0,0 +1,100 @@
+"""
+Shared access to new.db.
+
+Writers (ingest, the CLIs) get a connection from `connect`. Readers share
+one read-only connection per thread and database from `reader`, so a lookup
+never pays for opening the file again. Every connection runs in WAL mode
+with a large mmap window and page cache, and keeps its prepared statements
+around (sqlite3's statement cache reuses them for identical SQL, so always
+pass values as parameters rather than formatting them in).
+
+From async code, use `run`, which calls a function with a pooled reader on
+a worker thread instead of blocking the event loop.
+"""
+import asyncio, os, sqlite3, threading
+
+DB_PATH = os.getenv("DB_PATH", "new.db")
+
+MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", 64 * 1024))
+STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+BUSY_TIMEOUT = 30  # seconds a reader / writer waits on a lock before giving up
+
+_local = threading.local()
+_open = []  # (thread, reader) for every pooled reader, so `close_all` can reach other threads' too
+_open_lock = threading.Lock()
+_generation = 0  # bumped by close_all, so other threads drop their closed readers
+
+
+def _pragmas(conn):
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def connect(db_path=DB_PATH):
+    """A read-write connection for one caller. WAL lets pooled readers carry on while it writes."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")  # safe with WAL, and much cheaper per commit
+    _pragmas(conn)
+    return conn
+
+
+def reader(db_path=DB_PATH):
+    """This thread's read-only connection to `db_path`, opened on first use."""
+    pool = getattr(_local, "pool", None)
+    if pool is None or _local.generation != _generation:
+        pool = _local.pool = {}
+        _local.generation = _generation
+    conn = pool.get(db_path)
+    if conn is None:
+        uri = f"file:{os.path.abspath(db_path)}?mode=ro"
+        conn = sqlite3.connect(
+            uri, uri=True, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE, check_same_thread=False
+        )
+        _pragmas(conn)
+        conn.execute("PRAGMA query_only = ON")
+        pool[db_path] = conn
+        with _open_lock:
+            # Readers of threads that have since exited would otherwise stay open for good.
+            dead = [c for thread, c in _open if not thread.is_alive()]
+            _open[:] = [(thread, c) for thread, c in _open if thread.is_alive()]
+            _open.append((threading.current_thread(), conn))
+        for c in dead:
+            c.close()
+    return conn
+
+
+def query(sql, params=(), db_path=DB_PATH):
+    return reader(db_path).execute(sql, params).fetchall()
+
+
+def query_one(sql, params=(), db_path=DB_PATH):
+    return reader(db_path).execute(sql, params).fetchone()
+
+
+async def run(fn, *args, db_path=DB_PATH):
+    """Calls fn(conn, *args) with a pooled reader, off the event loop."""
+    return await asyncio.to_thread(lambda: fn(reader(db_path), *args))
+
+
+def mtime(db_path=DB_PATH):
+    """
+    When `db_path` last changed. In WAL mode commits land in the -wal file
+    and only reach the main file at a checkpoint, so both count.
+    """
+    times = [os.path.getmtime(p) for p in (db_path, f"{db_path}-wal") if os.path.exists(p)]
+    if not times:
+        raise FileNotFoundError(db_path)
+    return max(times)
+
+
+def close_all():
+    """Closes every pooled reader (e.g. before forking, or in tests)."""
+    global _generation
+    with _open_lock:
+        conns, _open[:] = [c for _, c in _open], []
+        _generation += 1
+    for conn in conns:
+        conn.close()
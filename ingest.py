@@ -0,0 +1,423 @@
+import glob, hashlib, os, shutil, string, threading, time, multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import db, media, quality, stats
+
+DB_PATH = os.getenv("DB_PATH", "new.db")
+DOWNLOAD_DIR = "downloads"
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "tiny.en")
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+WRITE_BATCH = int(os.getenv("WRITE_BATCH", 16))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 4))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+
+
+def connect(db_path=DB_PATH):
+    conn = db.connect(db_path)
+    init_db(conn)
+    return conn
+
+
+def init_db(conn):
+    c = conn.cursor()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS words (
+        id       INTEGER PRIMARY KEY,
+        video_id TEXT NOT NULL,
+        word     TEXT NOT NULL COLLATE NOCASE,
+        start    REAL NOT NULL,
+        end      REAL NOT NULL
+    );
+    """)
+    # Per-occurrence quality features (see quality.py); NULL for rows from
+    # before they were recorded.
+    columns = {row[1] for row in c.execute("PRAGMA table_info(words)")}
+    for column in ("probability", "rms"):
+        if column not in columns:
+            c.execute(f"ALTER TABLE words ADD COLUMN {column} REAL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_word_text ON words(word);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_word_video_id ON words(video_id);")
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS segments (
+        id          INTEGER PRIMARY KEY,
+        video_id    TEXT NOT NULL,
+        segment_text TEXT NOT NULL COLLATE NOCASE,
+        start       REAL NOT NULL,
+        end         REAL NOT NULL
+    );
+    """)
+    # —  Create an FTS5 “shadow” for fast phrase searches —
+    c.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts
+      USING fts5(
+        segment_text,
+        video_id    UNINDEXED,
+        start       UNINDEXED,
+        end         UNINDEXED,
+        content='segments',       -- tie it to the real segments table
+        content_rowid='id'         -- use the same rowid as segments.id
+      );
+    """)
+
+    # Populate it once from any existing segments rows:
+    c.execute("""
+    INSERT INTO segments_fts(rowid, segment_text, video_id, start, end)
+      SELECT id, segment_text, video_id, start, end FROM segments
+      WHERE id NOT IN (SELECT rowid FROM segments_fts);
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_segment_text ON segments(segment_text);") # Crucial for segment lookup
+    c.execute("CREATE INDEX IF NOT EXISTS idx_segment_video_id ON segments(video_id);")
+
+    # One row per video that has been fully transcribed (even if it had no speech),
+    # which is what makes ingest resumable.
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS videos (
+        video_id       TEXT PRIMARY KEY,
+        transcribed_at REAL
+    );
+    """)
+    c.execute("""
+    INSERT OR IGNORE INTO videos (video_id, transcribed_at)
+      SELECT DISTINCT video_id, NULL FROM segments;
+    """)
+
+    # One row per video (re)written to `words`. Its generation numbers are
+    # what running apps compare to the index they have loaded; they pick up
+    # only the videos logged since (see compact_index.build_delta).
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS index_log (
+        generation   INTEGER PRIMARY KEY AUTOINCREMENT,
+        video_id     TEXT NOT NULL,
+        published_at REAL NOT NULL
+    );
+    """)
+
+    # Download state per Short: pending | downloaded | failed
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS manifest (
+        video_id   TEXT PRIMARY KEY,
+        state      TEXT NOT NULL DEFAULT 'pending',
+        reason     TEXT,
+        attempts   INTEGER NOT NULL DEFAULT 0,
+        duration   REAL,
+        size       INTEGER,
+        checksum   TEXT,
+        updated_at REAL
+    );
+    """)
+
+    # What ffprobe says about each downloaded file, so renders never have to
+    # probe. status: ok | missing | corrupt
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS media (
+        video_id   TEXT PRIMARY KEY,
+        width      INTEGER,
+        height     INTEGER,
+        fps        REAL,
+        duration   REAL,
+        audio_rate INTEGER,
+        keyframes  TEXT,        -- JSON list of keyframe timestamps
+        size       INTEGER,
+        mtime      REAL,
+        status     TEXT NOT NULL,
+        error      TEXT,
+        probed_at  REAL
+    );
+    """)
+
+    # Materialized word / n-gram counts, kept in step with `words`.
+    stats.init(c)
+    conn.commit()
+
+
+def pending_videos(conn, video_ids):
+    """Returns the ids from `video_ids` that haven't been transcribed yet, in one query."""
+    c = conn.cursor()
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS candidates (video_id TEXT PRIMARY KEY)")
+    c.execute("DELETE FROM candidates")
+    c.executemany("INSERT OR IGNORE INTO candidates VALUES (?)", [(v,) for v in video_ids])
+    c.execute("SELECT video_id FROM candidates EXCEPT SELECT video_id FROM videos")
+    pending = {v for v, in c.fetchall()}
+    return [v for v in dict.fromkeys(video_ids) if v in pending]
+
+
+class DownloadError(Exception):
+    def __init__(self, msg, retryable=True):
+        super().__init__(msg, retryable)
+        self.msg = msg
+        self.retryable = retryable
+
+    def __str__(self):
+        return self.msg
+
+
+class YtDlpDownloader:
+    """Downloads a Short to `out_path` with yt-dlp. One YoutubeDL per thread."""
+
+    def __init__(self, download_dir=DOWNLOAD_DIR):
+        self.download_dir = download_dir
+        self._local = threading.local()
+
+    def _ydl(self):
+        if not hasattr(self._local, "ydl"):
+            import yt_dlp
+            self._local.ydl = yt_dlp.YoutubeDL({
+                'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]',
+                'outtmpl': os.path.join(self.download_dir, '%(id)s.%(ext)s'),
+                'merge_output_format': 'mp4',
+                'noplaylist': True,
+                'quiet': True,
+                'nocheckcertificate': True
+            })
+        return self._local.ydl
+
+    def __call__(self, video_id, out_path):
+        try:
+            self._ydl().download([f"https://www.youtube.com/watch?v={video_id}"])
+        except Exception as e:
+            if "This video may be inappropriate for some users." in str(e):
+                raise DownloadError("Video may be inappropriate for some users.", retryable=False)
+            raise DownloadError(str(e))
+
+
+class FakeDownloader:
+    """Offline stand-in for YtDlpDownloader that copies `<video_id>.mp4` out of `source_dir`."""
+
+    def __init__(self, source_dir, fail=()):
+        self.source_dir = source_dir
+        self.fail = set(fail)
+
+    def __call__(self, video_id, out_path):
+        src = os.path.join(self.source_dir, f"{video_id}.mp4")
+        if video_id in self.fail or not os.path.exists(src):
+            raise DownloadError(f"No source for {video_id}")
+        shutil.copyfile(src, out_path)
+
+
+def _checksum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _clean_partials(download_dir, video_id):
+    for leftover in glob.glob(os.path.join(glob.escape(download_dir), f"{glob.escape(video_id)}.*")):
+        if not leftover.endswith(f"{video_id}.mp4"):
+            os.remove(leftover)
+
+
+def _fetch(downloader, video_id, download_dir, retries, backoff):
+    """Runs in a download thread. Returns (attempts, size, checksum) or raises DownloadError."""
+    out_path = os.path.join(download_dir, f"{video_id}.mp4")
+    for attempt in range(retries + 1):
+        _clean_partials(download_dir, video_id)
+        try:
+            downloader(video_id, out_path)
+            if not os.path.exists(out_path) or os.path.getsize(out_path) == 0:
+                raise DownloadError("Downloader finished without producing a file.")
+            return attempt + 1, os.path.getsize(out_path), _checksum(out_path)
+        except DownloadError as e:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            if not e.retryable or attempt == retries:
+                e.attempts = attempt + 1
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def download(conn, shorts, downloader=None, workers=DOWNLOAD_WORKERS, retries=DOWNLOAD_RETRIES, backoff=2.0, download_dir=DOWNLOAD_DIR):
+    """
+    Downloads `shorts` ([(video_id, duration)]) with `workers` threads, keeping
+    the manifest table up to date. Yields (video_id, error) as soon as each
+    video is available, so the transcription stage can start right away.
+    Videos the manifest already has on disk come first, interleaved with
+    downloads that finish while the caller is busy with them.
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    downloader = downloader or YtDlpDownloader(download_dir)
+    c = conn.cursor()
+    c.executemany(
+        "INSERT OR IGNORE INTO manifest (video_id, duration, updated_at) VALUES (?, ?, ?)",
+        [(vid, sec, time.time()) for vid, sec in shorts]
+    )
+    conn.commit()
+
+    local, todo = [], []
+    for vid, _ in shorts:
+        state, size = c.execute("SELECT state, size FROM manifest WHERE video_id = ?", (vid,)).fetchone()
+        path = os.path.join(download_dir, f"{vid}.mp4")
+        if state == "downloaded" and os.path.exists(path) and os.path.getsize(path) == size:
+            local.append((vid, False))
+        elif state == "pending" and os.path.exists(path):
+            local.append((vid, True))  # downloaded before the manifest existed; adopt it
+        else:
+            todo.append(vid)
+
+    def finish(fut, vid):
+        try:
+            attempts, size, checksum = fut.result()
+        except DownloadError as e:
+            c.execute(
+                "UPDATE manifest SET state = 'failed', reason = ?, attempts = attempts + ?, updated_at = ? WHERE video_id = ?",
+                (e.msg, getattr(e, "attempts", 1), time.time(), vid)
+            )
+            conn.commit()
+            return vid, e
+        c.execute(
+            "UPDATE manifest SET state = 'downloaded', reason = NULL, attempts = attempts + ?, size = ?, checksum = ?, updated_at = ? WHERE video_id = ?",
+            (attempts, size, checksum, time.time(), vid)
+        )
+        conn.commit()
+        return vid, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Downloads start before anything is yielded, so they carry on while
+        # the caller works through the files that are already on disk.
+        futures = {pool.submit(_fetch, downloader, vid, download_dir, retries, backoff): vid for vid in todo}
+        running = set(futures)
+        for vid, adopt in local:
+            if adopt:
+                path = os.path.join(download_dir, f"{vid}.mp4")
+                c.execute(
+                    "UPDATE manifest SET state = 'downloaded', size = ?, checksum = ?, updated_at = ? WHERE video_id = ?",
+                    (os.path.getsize(path), _checksum(path), time.time(), vid)
+                )
+                conn.commit()
+            yield vid, None
+            # Hand over whatever finished downloading in the meantime too.
+            for fut in [f for f in running if f.done()]:
+                running.discard(fut)
+                yield finish(fut, futures[fut])
+        for fut in as_completed(running):
+            yield finish(fut, futures[fut])
+
+
+_model = None
+_decode_audio = None
+AUDIO_RATE = 16000  # what faster-whisper decodes to
+
+def _init_worker(model_name, cpu_threads):
+    global _model, _decode_audio
+    from faster_whisper import WhisperModel, decode_audio
+    _model = WhisperModel(model_name, cpu_threads=cpu_threads)
+    _decode_audio = decode_audio
+
+
+def transcribe_file(video_id, path):
+    """Runs in a worker process. Returns (video_id, segment rows, word rows, media info)."""
+    info = media.probe(path)
+    if info["status"] != "ok":
+        raise RuntimeError(f"{video_id} is {info['status']}: {info['error']}")
+    # Decoded once: whisper transcribes it and each word's loudness is measured on it.
+    audio = _decode_audio(path, sampling_rate=AUDIO_RATE)
+    segments, _ = _model.transcribe(audio, language="en", word_timestamps=True, append_punctuations="")
+    words_to_insert = []
+    segments_to_insert = []
+    for seg in segments:
+        if seg.words:
+            segment_start = seg.words[0].start
+            segment_end = seg.words[-1].end
+            segment_text = seg.text.strip().lower().strip(string.punctuation)
+
+            segments_to_insert.append(
+                (video_id, segment_text, segment_start, segment_end)
+            )
+
+            for w in seg.words:
+                clean_word = w.word.strip().lower().strip(string.punctuation)
+                if clean_word:
+                    words_to_insert.append(
+                        (video_id, clean_word, w.start, w.end, w.probability, quality.rms(audio, AUDIO_RATE, w.start, w.end))
+                    )
+        else:
+            print(f"Warning: Segment without words for {video_id} at ~{seg.start:.2f}s: '{seg.text.strip()}'")
+    return video_id, segments_to_insert, words_to_insert, info
+
+
+def _purge(c, video_id):
+    # Drop anything a previous, interrupted run left behind for this video.
+    for row in c.execute("SELECT id, segment_text, video_id, start, end FROM segments WHERE video_id = ?", (video_id,)).fetchall():
+        c.execute("INSERT INTO segments_fts(segments_fts, rowid, segment_text, video_id, start, end) VALUES ('delete', ?, ?, ?, ?, ?)", row)
+    c.execute("DELETE FROM segments WHERE video_id = ?", (video_id,))
+    stats.remove(c, video_id)
+    c.execute("DELETE FROM words WHERE video_id = ?", (video_id,))
+
+
+def write_batch(conn, results):
+    """Writes a batch of transcriptions in a single transaction. Videos already marked done are skipped."""
+    c = conn.cursor()
+    written = []
+    for video_id, segments_to_insert, words_to_insert, info in results:
+        if c.execute("SELECT transcribed_at FROM videos WHERE video_id = ?", (video_id,)).fetchone():
+            continue
+        _purge(c, video_id)
+        for row in segments_to_insert:
+            c.execute("INSERT INTO segments (video_id, segment_text, start, end) VALUES (?, ?, ?, ?)", row)
+            # mirror into FTS table
+            c.execute(
+                "INSERT INTO segments_fts(rowid, segment_text, video_id, start, end) VALUES (?, ?, ?, ?, ?)",
+                (c.lastrowid, row[1], row[0], row[2], row[3])
+            )
+        if words_to_insert:
+            c.executemany(
+                "INSERT INTO words (video_id, word, start, end, probability, rms) VALUES (?, ?, ?, ?, ?, ?)",
+                words_to_insert
+            )
+        stats.update(c, video_id, words_to_insert)
+        media.write(c, video_id, info)
+        c.execute("INSERT INTO index_log (video_id, published_at) VALUES (?, ?)", (video_id, time.time()))
+        c.execute("INSERT OR REPLACE INTO videos (video_id, transcribed_at) VALUES (?, ?)", (video_id, time.time()))
+        written.append(video_id)
+    conn.commit()
+    return written
+
+
+def transcribe(conn, video_ids, workers=TRANSCRIBE_WORKERS, batch_size=WRITE_BATCH, download_dir=DOWNLOAD_DIR, model_name=WHISPER_MODEL):
+    """
+    Transcribes `video_ids` across a pool of `workers` processes and feeds the
+    results to a single batched writer. `video_ids` may be any iterable,
+    including one that is still being produced (e.g. by the download stage).
+
+    Yields (video_id, error) as each video is committed or fails.
+    """
+    cpu_threads = max(1, (os.cpu_count() or 1) // workers)
+    batch = []
+    running = set()
+
+    def flush():
+        for video_id in write_batch(conn, batch):
+            yield video_id, None
+        batch.clear()
+
+    def collect(done):
+        for fut in done:
+            running.discard(fut)
+            try:
+                batch.append(fut.result())
+            except Exception as e:
+                yield fut.video_id, e
+
+    # Spawned, not forked: the download threads may be running while workers start.
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker, initargs=(model_name, cpu_threads)) as pool:
+        for video_id in video_ids:
+            fut = pool.submit(transcribe_file, video_id, os.path.join(download_dir, f"{video_id}.mp4"))
+            fut.video_id = video_id
+            running.add(fut)
+
+            # Keep a bounded number of files in flight.
+            if len(running) >= workers * 2:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+            if len(batch) >= batch_size:
+                yield from flush()
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            yield from collect(done)
+            if len(batch) >= batch_size:
+                yield from flush()
+        yield from flush()
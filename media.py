@@ -0,0 +1,246 @@
+import json, os, sqlite3, subprocess as sp, threading, time
+import db
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+DB_PATH = os.getenv("DB_PATH", "new.db")
+DOWNLOAD_DIR = "downloads"
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY", "ffprobe")
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", 4))
+
+# A cut may move this far back to land on a keyframe, so ffmpeg can start
+# decoding right where it seeks instead of rolling forward from the last one.
+KEYFRAME_SNAP = float(os.getenv("KEYFRAME_SNAP", 0.08))
+
+# How often MediaTable checks new.db for changes, in the background.
+RELOAD_INTERVAL = float(os.getenv("MEDIA_RELOAD_INTERVAL", 5))
+
+# Rendering from these would fail (or render garbage) halfway through.
+BAD_STATUSES = ("missing", "corrupt")
+
+
+def _ffprobe(*args):
+    proc = sp.run([FFPROBE_BINARY, "-v", "error", *args], stdout=sp.PIPE, stderr=sp.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode(errors="ignore").strip() or f"ffprobe exited with {proc.returncode}")
+    return proc.stdout.decode(errors="ignore")
+
+
+def _rate(value):
+    num, _, den = (value or "0/1").partition("/")
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def probe(path):
+    """
+    Everything the render path needs to know about a source file, read with
+    ffprobe. Keyframes come from packet flags, so nothing is decoded.
+    """
+    if not os.path.exists(path):
+        return {"status": "missing", "error": f"{path} not found"}
+    stat = os.stat(path)
+    info = {"size": stat.st_size, "mtime": stat.st_mtime}
+    try:
+        meta = json.loads(_ffprobe(
+            "-show_entries", "format=duration:stream=codec_type,width,height,avg_frame_rate,sample_rate",
+            "-of", "json", path,
+        ))
+        packets = _ffprobe(
+            "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+            "-of", "csv=p=0", path,
+        )
+    except (RuntimeError, ValueError) as e:
+        return {**info, "status": "corrupt", "error": str(e)}
+
+    streams = meta.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video is None or audio is None:
+        return {**info, "status": "corrupt", "error": "no video stream" if video is None else "no audio stream"}
+
+    keyframes = []
+    for line in packets.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            keyframes.append(round(float(pts), 3))
+
+    return {
+        **info,
+        "status": "ok",
+        "width": int(video.get("width") or 0),
+        "height": int(video.get("height") or 0),
+        "fps": _rate(video.get("avg_frame_rate")),
+        "duration": float(meta.get("format", {}).get("duration") or 0),
+        "audio_rate": int(audio.get("sample_rate") or 0),
+        "keyframes": sorted(keyframes),
+    }
+
+
+def write(c, video_id, info):
+    c.execute("""
+        INSERT OR REPLACE INTO media
+            (video_id, width, height, fps, duration, audio_rate, keyframes, size, mtime, status, error, probed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        video_id, info.get("width"), info.get("height"), info.get("fps"), info.get("duration"),
+        info.get("audio_rate"), json.dumps(info["keyframes"]) if "keyframes" in info else None,
+        info.get("size"), info.get("mtime"), info["status"], info.get("error"), time.time(),
+    ))
+
+
+def refresh(conn, video_ids=None, workers=PROBE_WORKERS, download_dir=DOWNLOAD_DIR, force=False):
+    """
+    Probes every transcribed video (or just `video_ids`) that has no media
+    row yet, or whose file changed since it was probed. Yields
+    (video_id, status) as rows are written.
+    """
+    c = conn.cursor()
+    if video_ids is None:
+        video_ids = [v for v, in c.execute("SELECT video_id FROM videos")]
+    known = {v: (size, mtime) for v, size, mtime in c.execute("SELECT video_id, size, mtime FROM media")}
+
+    def stale(video_id):
+        if force or video_id not in known:
+            return True
+        path = os.path.join(download_dir, f"{video_id}.mp4")
+        if not os.path.exists(path):
+            return known[video_id] != (None, None)
+        stat = os.stat(path)
+        return known[video_id] != (stat.st_size, stat.st_mtime)
+
+    todo = [v for v in dict.fromkeys(video_ids) if stale(v)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for video_id, info in zip(todo, pool.map(lambda v: probe(os.path.join(download_dir, f"{v}.mp4")), todo)):
+            write(c, video_id, info)
+            conn.commit()
+            yield video_id, info["status"]
+
+
+class MediaTable:
+    """
+    In-memory copy of the `media` table. Lookups only ever read the copy;
+    every `interval` seconds one of them also queues a background reload,
+    which re-reads the table if the DB changed. Call `load` (e.g. through
+    db.run) before the first lookup, or that one loads it in place.
+    """
+
+    def __init__(self, db_path=DB_PATH, interval=RELOAD_INTERVAL):
+        self.db_path = db_path
+        self.interval = interval
+        self._mtime = None
+        self._rows = None
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+        # One long-lived thread, so reloads reuse its pooled reader.
+        self._reloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-reload")
+
+    def ready(self):
+        return self._rows is not None
+
+    def load(self, conn=None):
+        """Re-reads the table through `conn` (default: this thread's reader) if the DB changed since the last load."""
+        with self._lock:
+            try:
+                mtime = db.mtime(self.db_path)
+            except OSError:
+                self._rows = self._rows or {}
+                return
+            if mtime == self._mtime:
+                return
+            try:
+                rows = (conn or db.reader(self.db_path)).execute(
+                    "SELECT video_id, width, height, fps, duration, audio_rate, keyframes, status FROM media"
+                ).fetchall()
+            except sqlite3.OperationalError:
+                rows = []  # pre-media database
+            self._rows = {
+                r[0]: {
+                    "width": r[1], "height": r[2], "fps": r[3], "duration": r[4], "audio_rate": r[5],
+                    "keyframes": json.loads(r[6]) if r[6] else [], "status": r[7],
+                }
+                for r in rows
+            }
+            self._mtime = mtime
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception as e:
+            print(f"⚠️ Media table reload failed: {e}")
+
+    def get(self, video_id):
+        if self._rows is None:
+            self.load()
+        elif time.monotonic() - self._checked >= self.interval:
+            self._checked = time.monotonic()
+            self._reloader.submit(self._reload)
+        return self._rows.get(video_id)
+
+    def usable(self, video_id):
+        # Videos that were never probed get the benefit of the doubt.
+        info = self.get(video_id)
+        return info is None or info["status"] not in BAD_STATUSES
+
+    def choose(self, candidates, rng, size=None):
+        """
+        Picks one occurrence with `rng`, weighted by its quality score,
+        skipping sources known to be broken and preferring ones already at
+        the output `size` (no scaling needed). None if every candidate is broken.
+        """
+        def native(c):
+            info = self.get(c["video_id"])
+            return info is not None and (info["width"], info["height"]) == tuple(size)
+
+        ok = [c for c in candidates if self.usable(c["video_id"])]
+        if not ok:
+            return None
+        if size is not None:
+            ok = [c for c in ok if native(c)] or ok
+        return rng.choices(ok, weights=[c.get("score", 1.0) for c in ok])[0]
+
+    def annotate(self, sel, tolerance=KEYFRAME_SNAP):
+        """
+        Adds the source's size to a selection and, if a keyframe sits at most
+        `tolerance` seconds before `start`, moves the cut back onto it.
+        """
+        info = self.get(sel["video_id"])
+        if info is None or info["status"] != "ok":
+            return sel
+        sel = {**sel, "source_size": (info["width"], info["height"])}
+        keyframes = info["keyframes"]
+        i = bisect_right(keyframes, sel["start"])
+        if i and sel["start"] - keyframes[i - 1] <= tolerance:
+            sel["start"] = keyframes[i - 1]
+        return sel
+
+
+def check(conn, download_dir=DOWNLOAD_DIR):
+    """Marks videos whose file is gone as missing and re-probes changed ones. Returns the bad (video_id, status, error) rows."""
+    for _ in refresh(conn, download_dir=download_dir):
+        pass
+    return conn.execute(
+        f"SELECT video_id, status, error FROM media WHERE status IN ({','.join('?' * len(BAD_STATUSES))}) ORDER BY video_id",
+        BAD_STATUSES,
+    ).fetchall()
+
+
+if __name__ == "__main__":
+    import sys
+    import ingest
+
+    conn = ingest.connect(DB_PATH)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if cmd == "probe":
+        n = sum(1 for _ in refresh(conn, force="--force" in sys.argv))
+        print(f"🔎 Probed {n} videos.")
+    elif cmd == "check":
+        bad = check(conn)
+        for video_id, status, error in bad:
+            print(f"⚠️ {video_id}: {status} ({error})")
+        print(f"✅ {len(bad)} broken videos." if bad else "✅ Every video is playable.")
+    else:
+        print("Usage: python media.py [probe [--force] | check]")
+    conn.close()
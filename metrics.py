@@ -0,0 +1,147 @@
+import threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, labels=(), fn=None):
+        super().__init__(registry, name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.fn is not None:
+            self.set(self.fn())
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, n = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0, 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, n + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, (counts, total, n) in sorted(self._values.items()):
+                running = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    running += count
+                    labels = _labels(self.label_names + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {running}")
+                labels = _labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """The Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Stage timings for a single request, optionally sent back with the `done` event."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        return {"total": time.perf_counter() - self.started, **self.stages}
+
+    def observe(self):
+        """Feeds every stage of this request into `stage_seconds`."""
+        for name, seconds in self.as_dict().items():
+            stage_seconds.observe(seconds, stage=name)
+
+
+registry = Registry()
+
+renders = Counter(registry, "zdf_renders_total", "Renders finished, by outcome and render path.", ("status", "mode"))
+render_bytes = Counter(registry, "zdf_render_bytes_total", "MP4 bytes produced by renders.")
+stage_seconds = Histogram(registry, "zdf_stage_seconds", "Time spent per request stage.", ("stage",))
+ffmpeg_exits = Counter(registry, "zdf_ffmpeg_exit_total", "ffmpeg encoder exit codes.", ("code",))
+words_looked_up = Counter(registry, "zdf_words_total", "Words looked up in the index, by whether they were found.", ("result",))
+cache_requests = Counter(registry, "zdf_cache_requests_total", "Cache lookups, by cache and result.", ("cache", "result"))
@@ -0,0 +1,38 @@
+import os
+
+# Selection samples from this many of a word's best occurrences, weighted by score.
+TOP_K = int(os.getenv("QUALITY_TOP_K", 8))
+
+# Sources at least this tall never get marked down for resolution.
+TARGET_HEIGHT = int(os.getenv("CLIP_SIZE", "404x720").split("x")[1])
+
+GOOD_DURATION = 0.25  # words shorter than this are usually clipped by whisper
+GOOD_MARGIN = 0.15    # silence needed on both sides for a cut that doesn't bleed
+GOOD_RMS = 0.03       # quieter than this is mumbled or under music
+
+
+def _clamp(x, lo=0.0, hi=1.0):
+    return max(lo, min(hi, x))
+
+
+def score(probability=None, duration=0.0, lead=0.0, trail=0.0, rms=None, height=None):
+    """
+    How good an occurrence is as a standalone clip, in (0, 1]. Missing
+    features (older rows, unprobed sources) count as neutral.
+    """
+    s = 0.7 if probability is None else _clamp(probability, 0.05)
+    s *= _clamp(duration / GOOD_DURATION, 0.2)
+    s *= 0.5 + 0.5 * _clamp(min(lead, trail) / GOOD_MARGIN)
+    if rms is not None:
+        s *= _clamp(rms / GOOD_RMS, 0.2)
+    if height:
+        s *= _clamp(height / TARGET_HEIGHT, 0.3)
+    return s
+
+
+def rms(samples, rate, start, end):
+    """Root mean square of mono float `samples` between `start` and `end` seconds."""
+    chunk = samples[max(int(start * rate), 0):max(int(end * rate), 0)]
+    if len(chunk) == 0:
+        return 0.0
+    return float((chunk.astype("float64") ** 2).mean() ** 0.5)
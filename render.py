@@ -0,0 +1,594 @@
+import atexit, random, threading, time, os, subprocess as sp
+from collections import defaultdict
+from contextlib import contextmanager
+from clip_cache import get_cache, ffmpeg_binary, Cancelled, CLIP_SIZE, CLIP_FPS, AUDIO_FPS, AUDIO_CHANNELS
+
+# NumPy, PIL and moviepy are imported where they're used: the web process
+# only needs this module for profiles and settings, and the render workers
+# load them up front (see preload).
+
+FONT_PATH = "assets/font.ttf"
+WATERMARK = "zdf.mce.run"
+WATERMARK_INTERVAL = 2.5  # seconds between watermark jumps
+
+# "concat" builds the whole output inside ffmpeg; "frames" is the original
+# per-frame Python loop and is used as a fallback.
+RENDER_MODE = os.getenv("RENDER_MODE", "concat")
+
+# Named encoder profiles. `height` / `fps` of None mean the clip cache's
+# native CLIP_SIZE / CLIP_FPS.
+PROFILES = {
+    "preview":  {"preset": "ultrafast", "crf": 30, "height": 360, "fps": 15, "audio_bitrate": "64k"},
+    "standard": {"preset": "medium", "crf": 23, "height": None, "fps": None, "audio_bitrate": "128k"},
+    "high":     {"preset": "slow", "crf": 18, "height": None, "fps": None, "audio_bitrate": "192k"},
+}
+DEFAULT_PROFILE = os.getenv("RENDER_PROFILE", "auto")
+
+# Hard cap on output height; applied when clips are cut, before any frame reaches Python.
+MAX_OUTPUT_HEIGHT = int(os.getenv("MAX_OUTPUT_HEIGHT", CLIP_SIZE[1]))
+
+# Under auto, renders drop to preview once every worker is busy, or once half
+# of them are and the output would be long.
+LONG_RENDER_SECONDS = float(os.getenv("LONG_RENDER_SECONDS", 20))
+
+CHUNK_SIZE = 64 * 1024
+RING_FRAMES = 8
+
+# Idle frames-path encoders kept started per profile (0 turns the pool off).
+ENCODER_POOL = int(os.getenv("ENCODER_POOL", 1))
+
+# Every clip's audio fades in and out over this many seconds, so word
+# boundaries don't click. Clip lengths are untouched, which keeps A/V sync.
+AUDIO_FADE = float(os.getenv("AUDIO_FADE", 0.005))
+
+
+class Timings:
+    """Wall-clock seconds spent per render stage, summed over every frame / clip."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def mark(self, name):
+        """Records the time since the render started, the first time `name` happens."""
+        self.stages.setdefault(name, time.perf_counter() - self.started)
+
+    def as_dict(self):
+        return {"total": time.perf_counter() - self.started, **self.stages, **self.counts}
+
+
+class Watermark:
+    """The watermark text pre-rendered once as an RGBA sprite, alpha-blended into frames in place."""
+
+    def __init__(self, font, text=WATERMARK, color=(255, 255, 255)):
+        import numpy as np
+        from PIL import Image, ImageDraw
+
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new("L", (right, bottom), 0)
+        ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+        self.alpha = np.asarray(mask, dtype=np.int32)[:, :, None]
+        self.rgb = np.empty(self.alpha.shape[:2] + (3,), dtype=np.int32)
+        self.rgb[:] = color
+        self._scratch = np.empty_like(self.rgb)
+
+    def blend(self, frame, x, y):
+        import numpy as np
+
+        h = min(self.rgb.shape[0], frame.shape[0] - y)
+        w = min(self.rgb.shape[1], frame.shape[1] - x)
+        if h <= 0 or w <= 0:
+            return
+        roi = frame[y:y + h, x:x + w]
+        scratch = self._scratch[:h, :w]
+        # roi += (rgb - roi) * alpha / 255, without temporaries
+        np.subtract(self.rgb[:h, :w], roi, out=scratch)
+        np.multiply(scratch, self.alpha[:h, :w], out=scratch)
+        np.floor_divide(scratch, 255, out=scratch)
+        np.add(roi, scratch, out=roi, casting="unsafe")
+
+
+def assemble_audio(clips, fade=AUDIO_FADE, rate=AUDIO_FPS):
+    """
+    Joins the int16 PCM of cached clips into one (samples, channels) array in
+    a single copy, then ramps the edges of every clip in place.
+    """
+    import numpy as np
+
+    lengths = [len(c.audio) for c in clips]
+    out = np.empty((sum(lengths), AUDIO_CHANNELS), dtype=np.int16)
+    if not clips:
+        return out
+    np.concatenate([c.audio for c in clips], out=out)
+
+    ramp = np.linspace(0, 1, max(int(fade * rate), 1), endpoint=False, dtype=np.float32)[:, None]
+    pos = 0
+    for n in lengths:
+        k = min(len(ramp), n // 2)
+        if k:
+            head, tail = out[pos:pos + k], out[pos + n - k:pos + n]
+            np.multiply(head, ramp[:k], out=head, casting="unsafe")
+            np.multiply(tail, ramp[k - 1::-1], out=tail, casting="unsafe")
+        pos += n
+    return out
+
+
+def _write_all(fd, view):
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def pick_profile(requested=None, load=0.0, duration=0.0):
+    """
+    Resolves a requested profile name. "auto" (or anything unknown) picks one
+    from the current `load` (busy + queued renders per worker) and the output
+    `duration` in seconds.
+    """
+    requested = requested or DEFAULT_PROFILE
+    if requested in PROFILES:
+        return requested
+    if load >= 1 or (load >= 0.5 and duration > LONG_RENDER_SECONDS):
+        return "preview"
+    return "standard"
+
+
+def output_format(profile="standard"):
+    """(width, height, fps) a profile renders at."""
+    settings = PROFILES[profile]
+    height = min(settings["height"] or CLIP_SIZE[1], MAX_OUTPUT_HEIGHT)
+    width = int(round(CLIP_SIZE[0] * height / CLIP_SIZE[1] / 2)) * 2
+    return width, height, settings["fps"] or CLIP_FPS
+
+
+def encoder_args(profile="standard"):
+    # Output is a fragmented MP4 with a keyframe (and so a new fragment) every
+    # second, which is what lets it be played while it's still being encoded.
+    # High@3.1 matches the codec string the page gives MediaSource.
+    settings = PROFILES[profile]
+    return [
+        "-c:a", "aac", "-b:a", settings["audio_bitrate"],
+        "-c:v", "libx264",
+        "-preset", settings["preset"],
+        "-crf", str(settings["crf"]),
+        "-tune", "fastdecode",
+        "-profile:v", "high", "-level", "3.1",
+        "-pix_fmt", "yuv420p",
+        "-force_key_frames", "expr:gte(t,n_forced*1)",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "-f", "mp4",
+        "pipe:1",
+    ]
+
+
+def render_settings(mode=None, profile="standard"):
+    """Everything besides the clips themselves that changes what a render looks like."""
+    return {
+        "mode": mode or RENDER_MODE,
+        "profile": profile,
+        "format": list(output_format(profile)),
+        "encoder": encoder_args(profile),
+        "watermark": WATERMARK,
+    }
+
+
+class RenderError(Exception):
+    def __init__(self, msg, detail="", code=None):
+        super().__init__(msg, detail, code)
+        self.msg = msg
+        self.detail = detail
+        self.code = code  # ffmpeg's exit code, if it got that far
+
+
+class RenderCancelled(RenderError):
+    """Whoever asked for the render went away; ffmpeg has been killed."""
+
+
+def render(selections, mode=None, emit=None, stream=False, profile="standard"):
+    """
+    Renders the given word selections (dicts with 'video_id', 'video_path',
+    'start' and 'end') into a fragmented MP4 and returns its bytes.
+
+    `emit(event, data)` is called with progress updates as the render runs.
+    With `stream`, the MP4 is also emitted as ("chunk", {"seq", "bytes"})
+    events as soon as ffmpeg produces it. Per-stage timings are emitted as
+    a final ("timings", {...}) event. If `emit` has a `cancelled()` method
+    (see scheduler), the render stops with RenderCancelled once it's true.
+
+    `profile` is one of PROFILES and sets the output size, fps and encoder.
+    """
+    emit = emit or (lambda event, data: None)
+    mode = mode or RENDER_MODE
+    timings = Timings()
+    emit("progress", {"step": "concatenating"})
+    emit("progress", {"step": "rendering"})
+
+    cancelled = getattr(emit, "cancelled", lambda: False)
+    sent = []
+    def on_chunk(chunk):
+        if cancelled():
+            raise RenderCancelled("Render cancelled")
+        timings.mark("first_chunk")
+        if stream:
+            emit("chunk", {"seq": len(sent), "bytes": chunk})
+        sent.append(len(chunk))
+
+    video_bytes = None
+    if mode == "concat":
+        try:
+            video_bytes = render_concat(selections, on_chunk, timings, profile)
+            timings.counts["mode"] = "concat"
+        except RenderError as e:
+            # Can't switch paths once part of the stream has gone out.
+            if sent or isinstance(e, RenderCancelled):
+                raise
+            print(f"Concat render failed, falling back to frame loop: {e.msg}\n{e.detail}")
+    if video_bytes is None:
+        video_bytes = render_frames(selections, on_chunk, timings, profile)
+        timings.counts["mode"] = "frames"
+
+    timings.counts["bytes"] = len(video_bytes)
+    emit("timings", timings.as_dict())
+    return video_bytes
+
+
+def prefetch(video_id, spans, video_path=None, emit=None, profile="standard", nice=0):
+    """
+    Cuts every (start, end) in `spans` from one source into the clip cache
+    `profile` renders from, in a single pass over the file. Returns how many
+    clips weren't cached yet. `nice` lowers the cutting ffmpeg's priority.
+    If `emit` has a `cancelled()` method, the cut stops with RenderCancelled
+    once it's true.
+    """
+    w, h, fps = output_format(profile)
+    try:
+        return get_cache((w, h), fps).prefetch(video_id, spans, video_path, nice, getattr(emit, "cancelled", None))
+    except Cancelled:
+        raise RenderCancelled("Prefetch cancelled")
+
+
+def preload():
+    """Imports everything a render needs. Render workers run this as they start (see app.py)."""
+    import numpy, PIL.ImageFont, moviepy.editor
+    ffmpeg_binary()
+
+
+def is_cached(selections, profile="standard"):
+    """True if every selection is already cut into the clip cache `profile` renders from."""
+    w, h, fps = output_format(profile)
+    cache = get_cache((w, h), fps)
+    return all((s["video_id"], s["start"], s["end"]) in cache for s in selections)
+
+
+def _read_output(proc, on_chunk):
+    """Reads ffmpeg's stdout as it's produced. Returns (stdout bytes, stderr text, exit code)."""
+    err = []
+    err_thread = threading.Thread(target=lambda: err.append(proc.stderr.read()))
+    err_thread.start()
+
+    chunks = []
+    while chunk := proc.stdout.read1(CHUNK_SIZE):
+        on_chunk(chunk)
+        chunks.append(chunk)
+
+    err_thread.join()
+    return_code = proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+    return b"".join(chunks), err[0].decode(errors="ignore"), return_code
+
+
+def _watermark_expr(span, seed):
+    # Deterministic pseudo-random jump every WATERMARK_INTERVAL seconds.
+    a, b = seed
+    return f"'mod({a}*floor(t/{WATERMARK_INTERVAL})+{b},max({span},1))'"
+
+
+def _font_size(height):
+    return max(10, round(20 * height / CLIP_SIZE[1]))
+
+
+def render_concat(selections, on_chunk=lambda chunk: None, timings=None, profile="standard"):
+    """
+    Builds the output entirely inside ffmpeg: every selection becomes a trimmed
+    input, they're normalized and joined by the concat filter, and the
+    watermark is burned in with drawtext. No frames are materialized in Python.
+    """
+    w, h, fps = output_format(profile)
+    cmd = [ffmpeg_binary(), "-y", "-loglevel", "error"]
+    graph = []
+    pads = ""
+
+    for i, sel in enumerate(selections):
+        duration = max(sel["end"] - sel["start"], 1 / fps)
+        cmd.extend(["-ss", f"{sel['start']:.3f}", "-t", f"{duration:.3f}", "-i", sel["video_path"]])
+        # Sources already at the output size (per the media table) skip the scaler.
+        if tuple(sel.get("source_size") or ()) == (w, h):
+            normalize = f"setsar=1,fps={fps},"
+        else:
+            normalize = f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},"
+        graph.append(f"[{i}:v:0]{normalize}trim=duration={duration:.3f},setpts=PTS-STARTPTS[v{i}]")
+        graph.append(
+            f"[{i}:a:0]aresample=44100,aformat=channel_layouts=stereo,"
+            f"apad=whole_dur={duration:.3f},atrim=duration={duration:.3f},asetpts=PTS-STARTPTS[a{i}]"
+        )
+        pads += f"[v{i}][a{i}]"
+
+    graph.append(f"{pads}concat=n={len(selections)}:v=1:a=1[cv][outa]")
+    seed = (random.randint(1000, 9999), random.randint(0, 9999))
+    graph.append(
+        f"[cv]drawtext=fontfile={FONT_PATH}:text={WATERMARK}:fontsize={_font_size(h)}:fontcolor=white:"
+        f"x={_watermark_expr('w-tw', seed)}:y={_watermark_expr('h-th', seed[::-1])}[outv]"
+    )
+
+    cmd.extend(["-filter_complex", ";".join(graph), "-map", "[outv]", "-map", "[outa]"])
+    cmd.extend(encoder_args(profile))
+
+    timings = timings or Timings()
+    with timings.stage("encode"):
+        proc = sp.Popen(cmd, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE)
+        try:
+            video_bytes, err_str, return_code = _read_output(proc, on_chunk)
+        finally:
+            _reap(proc)
+    timings.counts["ffmpeg_exit"] = return_code
+    timings.counts["frames"] = int(sum(max(s["end"] - s["start"], 1 / fps) for s in selections) * fps)
+    if return_code != 0 or not video_bytes:
+        raise RenderError("FFmpeg execution error", err_str, return_code)
+    return video_bytes
+
+
+def _start_encoder(profile):
+    """Starts a frames-path encoder: rawvideo on stdin, s16le PCM on an extra pipe. Returns (proc, audio write fd)."""
+    w, h, fps = output_format(profile)
+    cmd = [
+        ffmpeg_binary(),
+        "-y",
+
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-s", f"{w}x{h}",
+        "-r", str(fps),
+        "-i", "pipe:0"
+    ]
+    audio_pipe_read_fd, audio_pipe_write_fd = os.pipe()
+
+    cmd.extend([
+        "-f", "s16le",
+        "-ar", str(AUDIO_FPS),
+        "-ac", str(AUDIO_CHANNELS),
+        "-i", f"pipe:{audio_pipe_read_fd}",
+    ])
+
+    cmd.extend([
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+    ])
+
+    cmd.extend(encoder_args(profile))
+
+    try:
+        proc = sp.Popen(
+            cmd,
+            stdin=sp.PIPE,
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+            pass_fds=[audio_pipe_read_fd],
+        )
+    except OSError:
+        os.close(audio_pipe_write_fd)
+        raise
+    finally:
+        # Only ffmpeg reads from it now.
+        os.close(audio_pipe_read_fd)
+    return proc, audio_pipe_write_fd
+
+
+def _reap(proc):
+    """Kills `proc` if it's still running (an error or a cancelled render) and waits for it."""
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+
+
+class EncoderPool:
+    """
+    Frames-path encoders started ahead of time. Their command only depends
+    on the profile, so the next job's ffmpeg is already exec'd and waiting on
+    its pipes when the job arrives. Keeps up to `size` idle per profile.
+    """
+
+    def __init__(self, size=ENCODER_POOL):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+        atexit.register(self.close)
+
+    def take(self, profile):
+        encoder = None
+        with self._lock:
+            idle = self._idle[profile]
+            while idle and encoder is None:
+                encoder = idle.pop()
+                if encoder[0].poll() is not None:
+                    self._discard(encoder)
+                    encoder = None
+        if self.size:
+            threading.Thread(target=self._refill, args=(profile,), daemon=True).start()
+        return encoder or _start_encoder(profile)
+
+    def _refill(self, profile):
+        with self._lock:
+            if len(self._idle[profile]) >= self.size:
+                return
+        encoder = _start_encoder(profile)
+        with self._lock:
+            if len(self._idle[profile]) < self.size:
+                self._idle[profile].append(encoder)
+                return
+        self._discard(encoder)
+
+    @staticmethod
+    def _discard(encoder):
+        proc, audio_fd = encoder
+        try:
+            os.close(audio_fd)
+        except OSError:
+            pass
+        _reap(proc)
+
+    def close(self):
+        with self._lock:
+            idle = [e for encoders in self._idle.values() for e in encoders]
+            self._idle.clear()
+        for encoder in idle:
+            self._discard(encoder)
+
+
+encoders = EncoderPool()
+
+
+def render_frames(selections, on_chunk=lambda chunk: None, timings=None, profile="standard"):
+    import numpy as np
+    from moviepy.editor import concatenate_videoclips
+    from PIL import ImageFont
+
+    timings = timings or Timings()
+    w, h, fps = output_format(profile)
+    # Clips are cut at the output size, so frames are never bigger than needed.
+    cache = get_cache((w, h), fps)
+    hits, misses = cache.hits, cache.misses
+    cached = []
+    for sel in selections:
+        with timings.stage("clip_open"):
+            try:
+                cached.append(cache.get(sel["video_id"], sel["start"], sel["end"], sel["video_path"]))
+            except (OSError, RuntimeError) as e:
+                # Missing source, ffmpeg failing to cut it, ...: report it like any other failed render.
+                raise RenderError("Failed to cut clips", str(e))
+    timings.counts["clip_hits"] = cache.hits - hits
+    timings.counts["clip_misses"] = cache.misses - misses
+
+    # Cached clips all share one size, so chaining them never has to composite.
+    final = concatenate_videoclips([c.to_videoclip(audio=False) for c in cached], method="chain")
+
+    audio_fps = AUDIO_FPS
+    proc, audio_pipe_write_fd = encoders.take(profile)
+
+    video_thread = None
+    audio_thread = None
+    writer_error = None
+
+    def write_video_data():
+        nonlocal writer_error
+        try:
+            total_frames = int(final.duration * fps) if final.duration else 0
+
+            if total_frames <= 0:
+                print("Warning: Video duration or FPS is zero or invalid. No frames to write.")
+                raise ValueError("Cannot process video with zero duration or fps.")
+
+            # Frames are assembled in a preallocated ring and flushed to ffmpeg
+            # straight from its memory once it's full; nothing is allocated per frame.
+            ring = np.empty((RING_FRAMES, h, w, 3), dtype=np.uint8)
+            ring_view = memoryview(ring).cast("B")
+            frame_size = h * w * 3
+            fd = proc.stdin.fileno()
+
+            sprite = Watermark(ImageFont.truetype(FONT_PATH, size=_font_size(h)))
+            sprite_h, sprite_w = sprite.alpha.shape[:2]
+            interval_frames = int(WATERMARK_INTERVAL * fps)
+            x, y = random.randint(0, max(w - sprite_w, 0)), random.randint(0, max(h - sprite_h, 0))
+
+            filled = 0
+            for i in range(total_frames):
+                if i % interval_frames == 0:
+                    x, y = random.randint(0, max(w - sprite_w, 0)), random.randint(0, max(h - sprite_h, 0))
+
+                slot = ring[filled]
+                with timings.stage("get_frame"):
+                    np.copyto(slot, final.get_frame(i / fps))
+                with timings.stage("watermark"):
+                    sprite.blend(slot, x, y)
+                filled += 1
+
+                if filled == RING_FRAMES:
+                    with timings.stage("pipe_write"):
+                        _write_all(fd, ring_view)
+                    filled = 0
+
+            if filled:
+                with timings.stage("pipe_write"):
+                    _write_all(fd, ring_view[:filled * frame_size])
+            timings.counts["frames"] = total_frames
+
+        except Exception as e:
+            print(f"ERROR in video writer thread: {e}")
+            import traceback
+            traceback.print_exc()
+            writer_error = e
+        finally:
+            timings.mark("frames_fed")
+            if proc.stdin and not proc.stdin.closed:
+                try:
+                    proc.stdin.close()
+                except OSError as oe:
+                    print(f"Video writer: Warning - error closing stdin: {oe}")
+            else:
+                print("Video writer: stdin already closed before finalization.")
+
+    def write_audio_data():
+        nonlocal writer_error
+        try:
+            # The cached PCM is already s16le at the output rate; it's joined
+            # once and handed to the pipe straight from the array's memory.
+            with timings.stage("audio"):
+                pcm = assemble_audio(cached, rate=audio_fps)
+            with timings.stage("audio_write"):
+                _write_all(audio_pipe_write_fd, memoryview(pcm).cast("B"))
+        except Exception as e:
+            print(f"ERROR in audio writer thread: {e}")
+            writer_error = e
+        finally:
+            try:
+                os.close(audio_pipe_write_fd)
+            except OSError:
+                pass
+
+
+    video_thread = threading.Thread(target=write_video_data)
+    video_thread.start()
+
+    audio_thread = threading.Thread(target=write_audio_data)
+    audio_thread.start()
+
+    try:
+        # Read the output while the writers are still feeding ffmpeg, so a full
+        # stdout pipe can never stall the encoder.
+        video_bytes, err_str, return_code = _read_output(proc, on_chunk)
+    finally:
+        # Makes the writers fail fast if we're bailing out early.
+        _reap(proc)
+        video_thread.join()
+        audio_thread.join()
+    # Whatever ffmpeg still needed after the last frame went in.
+    timings.mark("frames_fed")
+    timings.stages["encode"] = time.perf_counter() - timings.started - timings.stages["frames_fed"]
+    timings.counts["ffmpeg_exit"] = return_code
+
+    if writer_error:
+        raise RenderError("Data writing error", str(writer_error))
+
+    if return_code != 0:
+        print("FFmpeg Error Output:\n", err_str)
+        raise RenderError("FFmpeg execution error", err_str, return_code)
+
+    return video_bytes
@@ -0,0 +1,100 @@
+import hashlib, json, os, sqlite3, threading, time
+
+CACHE_DIR = os.path.join("cache", "renders")
+CACHE_BUDGET = int(os.getenv("RENDER_CACHE_BYTES", 512 * 1024 ** 2))
+CACHE_TTL = float(os.getenv("RENDER_CACHE_TTL", 7 * 24 * 3600))
+
+
+def make_key(words, selections, settings):
+    """Content address of a render: the normalized sentence, the exact clips used and the render settings."""
+    payload = json.dumps({
+        "sentence": " ".join(words),
+        "clips": [(s["video_id"], round(s["start"], 3), round(s["end"], 3)) for s in selections],
+        "settings": settings,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """
+    Finished MP4s on disk, addressed by `make_key`. Bounded by `budget` bytes
+    (least recently used go first) and entries older than `ttl` seconds expire.
+    """
+
+    def __init__(self, root=CACHE_DIR, budget=CACHE_BUDGET, ttl=CACHE_TTL):
+        self.root = root
+        self.budget = budget
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, "index.db"), timeout=30, check_same_thread=False)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS renders (
+            key       TEXT PRIMARY KEY,
+            bytes     INTEGER NOT NULL,
+            created   REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits      INTEGER NOT NULL DEFAULT 0
+        );
+        """)
+        self._conn.commit()
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT created FROM renders WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[0] > self.ttl:
+                self._drop([key])
+                return None
+            self._conn.execute("UPDATE renders SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self._conn.commit()
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._drop([key])
+            return None
+
+    def put(self, key, data):
+        if len(data) > self.budget:
+            return
+        tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO renders (key, bytes, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, len(data), now, now)
+            )
+            self._conn.commit()
+            self._evict(now)
+
+    def _drop(self, keys):
+        self._conn.executemany("DELETE FROM renders WHERE key = ?", [(k,) for k in keys])
+        self._conn.commit()
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, now):
+        expired = [k for k, in self._conn.execute("SELECT key FROM renders WHERE created < ?", (now - self.ttl,))]
+        total, = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM renders WHERE created >= ?", (now - self.ttl,)).fetchone()
+        victims = []
+        if total > self.budget:
+            for key, nbytes in self._conn.execute("SELECT key, bytes FROM renders WHERE created >= ? ORDER BY last_used", (now - self.ttl,)):
+                if total <= self.budget:
+                    break
+                victims.append(key)
+                total -= nbytes
+        if expired or victims:
+            self._drop(expired + victims)
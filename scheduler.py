@@ -0,0 +1,189 @@
+import asyncio, os, queue, threading, multiprocessing as mp
+from contextlib import aclosing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+RENDER_QUEUE = int(os.getenv("RENDER_QUEUE", 8))
+# How many workers speculative jobs (run_idle) may hold at once.
+IDLE_SLOTS = int(os.getenv("IDLE_SLOTS", 1))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Emitter:
+    """The `emit` jobs get: events go back to the event loop, and `cancelled()` says if nobody's listening anymore."""
+
+    def __init__(self, events, cancel):
+        self.events = events
+        self.cancel = cancel
+
+    def __call__(self, event, data):
+        self.events.put((event, data))
+
+    def cancelled(self):
+        return self.cancel.is_set()
+
+
+def _call(events, cancel, fn, args, kwargs):
+    # Runs inside a pool worker; progress goes back to the event loop via `events`.
+    return fn(*args, emit=_Emitter(events, cancel), **kwargs)
+
+
+def _noop():
+    pass
+
+
+def _get(events, timeout):
+    try:
+        return events.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+class RenderScheduler:
+    """
+    Runs blocking render jobs in a process pool so the event loop stays free.
+
+    At most `workers` jobs run at once and at most `max_queue` more wait for a
+    slot; anything beyond that is rejected with QueueFull. Speculative jobs
+    (run_idle) give their worker up as soon as a real one has to wait.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, max_queue=RENDER_QUEUE, idle_slots=IDLE_SLOTS, initializer=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.idle_slots = idle_slots
+        # Runs in every worker process as it starts (e.g. to import heavy modules).
+        self.initializer = initializer
+        self.started = False
+        self.running = 0
+        self.idle_running = 0
+        self._waiting = []
+        self._idle = []  # cancel events of the running idle jobs nobody has pre-empted yet
+        self._pool = None
+        self._manager = None
+        self._pool_lock = threading.Lock()
+        # One thread per running job waits on its event queue (twice that, so a
+        # cancelled job's last poll never holds up the next). They get their own
+        # pool so they never crowd asyncio.to_thread callers out of the default one.
+        self._pollers = ThreadPoolExecutor(max_workers=2 * workers, thread_name_prefix="render-events")
+
+    @property
+    def depth(self):
+        return len(self._waiting)
+
+    def _ensure_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                ctx = mp.get_context("spawn")
+                self._manager = ctx.Manager()
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=self.initializer)
+
+    def warm(self):
+        """Starts every worker process now (blocking), instead of on the first jobs."""
+        self._ensure_pool()
+        for fut in [self._pool.submit(_noop) for _ in range(self.workers)]:
+            fut.result()
+        self.started = True
+
+    def _release(self):
+        self.running -= 1
+        while self._waiting:
+            ticket = self._waiting.pop(0)
+            if not ticket.done():
+                self.running += 1
+                ticket.set_result(None)
+                break
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Schedules `fn(*args, emit=..., **kwargs)` and yields (event, data)
+        pairs: queue position updates while waiting, then whatever the job
+        emits, and finally ("result", return_value). If the caller stops
+        iterating before then, the job's `emit.cancelled()` turns true.
+        """
+        async with aclosing(self._run(fn, args, kwargs)) as events:
+            async for item in events:
+                yield item
+
+    async def _run(self, fn, args, kwargs, idle=False):
+        loop = asyncio.get_running_loop()
+        ticket = loop.create_future()
+        fut = cancel = None
+
+        if self.running < self.workers and not self._waiting:
+            self.running += 1
+            ticket.set_result(None)
+        elif len(self._waiting) >= self.max_queue:
+            raise QueueFull(f"{self.running} renders running and {len(self._waiting)} queued.")
+        else:
+            self._waiting.append(ticket)
+            if self._idle:
+                # Cache warming can wait, this can't: have one idle job stop
+                # and hand its worker over when it does.
+                self._idle.pop(0).set()
+
+        try:
+            position = None
+            while not ticket.done():
+                if self._waiting.index(ticket) + 1 != position:
+                    position = self._waiting.index(ticket) + 1
+                    yield "progress", {"step": "queued", "position": position}
+                await asyncio.wait({ticket}, timeout=0.5)
+
+            self._ensure_pool()
+            events = self._manager.Queue()
+            cancel = self._manager.Event()
+            if idle:
+                self._idle.append(cancel)
+            fut = loop.run_in_executor(self._pool, _call, events, cancel, fn, args, kwargs)
+
+            while True:
+                item = await loop.run_in_executor(self._pollers, _get, events, 0.1)
+                if item is not None:
+                    yield item
+                elif fut.done():
+                    break
+            while (item := _get(events, 0)) is not None:
+                yield item
+
+            yield "result", fut.result()
+        finally:
+            # The caller stopped listening (error, disconnect) before the job
+            # finished: tell it to stop instead of rendering for nobody.
+            if fut is not None and not fut.done():
+                cancel.set()
+            if cancel in self._idle:
+                self._idle.remove(cancel)
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+            elif ticket.done() and not ticket.cancelled():
+                self._release()
+
+    async def run_idle(self, fn, *args, **kwargs):
+        """
+        `run` for work nobody is waiting on yet (cache warming). It only
+        starts if a worker is free right now, nothing is queued and fewer
+        than `idle_slots` such jobs are running; otherwise it raises
+        QueueFull instead of taking a place in the queue. Once a real job
+        has to queue, the job's `emit.cancelled()` turns true so it hands its
+        worker over.
+        """
+        if self.running >= self.workers or self._waiting or self.idle_running >= self.idle_slots:
+            raise QueueFull("No idle worker.")
+        self.idle_running += 1
+        try:
+            async with aclosing(self._run(fn, args, kwargs, idle=True)) as events:
+                async for item in events:
+                    yield item
+        finally:
+            self.idle_running -= 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._manager.shutdown()
+            self._pool = self._manager = None
+            self.started = False
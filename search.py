@@ -1,4 +1,7 @@
-from vocabulary import word_index
+import db, stats
+from vocabulary import DB_PATH, suggester
+
+conn = db.reader(DB_PATH)
 
 while True:
     try:
@@ -7,7 +10,11 @@ while True:
         print()
         exit()
 
-    if word in word_index:
-        print(f"Zack D. Films has said this word {len(word_index[word])} times!")
+    count, videos = stats.word_count(conn, word)
+    if count:
+        print(f"Zack D. Films has said this word {count} times, in {videos} videos!")
     else:
-        print("Zack D. Films has said this word 0 times!")
\ No newline at end of file
+        print("Zack D. Films has said this word 0 times!")
+        suggestions = suggester.suggest(word)
+        if suggestions:
+            print("Did you mean: " + ", ".join(f"{s['word']} ({s['count']} times)" for s in suggestions))
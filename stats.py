@@ -0,0 +1,209 @@
+"""
+Corpus statistics kept in new.db next to the transcripts: word frequencies,
+per-video word counts and 2/3-gram counts. They're updated in the same
+transaction that writes a video's words (see ingest.write_batch), so reads
+never have to scan the words table.
+
+    python stats.py top 20
+    python stats.py ngrams 2 20
+    python stats.py word because
+    python stats.py coverage
+    python stats.py rebuild
+"""
+import json, os, string
+
+DB_PATH = os.getenv("DB_PATH", "new.db")
+COMMON_WORDS = os.getenv("COMMON_WORDS", os.path.join("assets", "common_words.txt"))
+NGRAM_SIZES = (2, 3)
+
+
+def init(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS word_freq (
+        word   TEXT PRIMARY KEY,
+        count  INTEGER NOT NULL,
+        videos INTEGER NOT NULL
+    );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_word_freq_count ON word_freq(count);")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS video_word_counts (
+        video_id     TEXT PRIMARY KEY,
+        words        INTEGER NOT NULL,
+        unique_words INTEGER NOT NULL
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS ngram_freq (
+        n      INTEGER NOT NULL,
+        ngram  TEXT NOT NULL,
+        count  INTEGER NOT NULL,
+        PRIMARY KEY (n, ngram)
+    );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ngram_freq_count ON ngram_freq(n, count);")
+    c.execute("CREATE TABLE IF NOT EXISTS stats_meta (key TEXT PRIMARY KEY, value TEXT);")
+    if c.execute("SELECT 1 FROM stats_meta WHERE key = 'built'").fetchone() is None:
+        rebuild(c)
+
+
+def _normalize(word):
+    return word.strip().lower().strip(string.punctuation)
+
+
+def _counts(words):
+    """(word counts, ngram counts) for one video's words in spoken order."""
+    freq, grams = {}, {}
+    for w in words:
+        freq[w] = freq.get(w, 0) + 1
+    for n in NGRAM_SIZES:
+        for i in range(len(words) - n + 1):
+            key = (n, " ".join(words[i:i + n]))
+            grams[key] = grams.get(key, 0) + 1
+    return freq, grams
+
+
+def _apply(c, video_id, words, sign):
+    freq, grams = _counts(words)
+    c.executemany("""
+        INSERT INTO word_freq (word, count, videos) VALUES (?, ?, ?)
+        ON CONFLICT(word) DO UPDATE SET count = count + excluded.count, videos = videos + excluded.videos
+    """, [(w, sign * k, sign) for w, k in freq.items()])
+    c.executemany("""
+        INSERT INTO ngram_freq (n, ngram, count) VALUES (?, ?, ?)
+        ON CONFLICT(n, ngram) DO UPDATE SET count = count + excluded.count
+    """, [(n, g, sign * k) for (n, g), k in grams.items()])
+    if sign < 0:
+        c.execute("DELETE FROM word_freq WHERE count <= 0")
+        c.execute("DELETE FROM ngram_freq WHERE count <= 0")
+        c.execute("DELETE FROM video_word_counts WHERE video_id = ?", (video_id,))
+    else:
+        c.execute(
+            "INSERT OR REPLACE INTO video_word_counts (video_id, words, unique_words) VALUES (?, ?, ?)",
+            (video_id, len(words), len(freq))
+        )
+
+
+def update(c, video_id, rows):
+    """Adds one video's (video_id, word, start, end, ...) rows to the counts."""
+    words = [_normalize(r[1]) for r in sorted(rows, key=lambda r: r[2])]
+    _apply(c, video_id, [w for w in words if w], 1)
+
+
+def remove(c, video_id):
+    """Takes a video's words (as currently in the words table) back out of the counts."""
+    if c.execute("SELECT 1 FROM video_word_counts WHERE video_id = ?", (video_id,)).fetchone() is None:
+        return
+    rows = c.execute("SELECT word FROM words WHERE video_id = ? ORDER BY start, id", (video_id,)).fetchall()
+    _apply(c, video_id, [w for w in (_normalize(w) for w, in rows) if w], -1)
+
+
+def rebuild(c):
+    """Recomputes everything from the words table."""
+    for table in ("word_freq", "video_word_counts", "ngram_freq"):
+        c.execute(f"DELETE FROM {table}")
+    video_id, words = None, []
+    for vid, word in c.execute("SELECT video_id, word FROM words ORDER BY video_id, start, id").fetchall():
+        if vid != video_id:
+            if words:
+                _apply(c, video_id, words, 1)
+            video_id, words = vid, []
+        word = _normalize(word)
+        if word:
+            words.append(word)
+    if words:
+        _apply(c, video_id, words, 1)
+    c.execute("INSERT OR REPLACE INTO stats_meta (key, value) VALUES ('built', '1')")
+
+
+def word_count(conn, word):
+    """(times said, videos it's said in) for `word`."""
+    row = conn.execute("SELECT count, videos FROM word_freq WHERE word = ?", (_normalize(word),)).fetchone()
+    return row or (0, 0)
+
+
+def frequencies(conn):
+    return dict(conn.execute("SELECT word, count FROM word_freq"))
+
+
+def top_words(conn, limit=10):
+    return conn.execute("SELECT word, count FROM word_freq ORDER BY count DESC, word LIMIT ?", (limit,)).fetchall()
+
+
+def top_ngrams(conn, n=2, limit=10):
+    return conn.execute(
+        "SELECT ngram, count FROM ngram_freq WHERE n = ? ORDER BY count DESC, ngram LIMIT ?", (n, limit)
+    ).fetchall()
+
+
+def common_words(path=COMMON_WORDS):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [w for w in (_normalize(line) for line in f) if w]
+    except FileNotFoundError:
+        return []
+
+
+def coverage(conn, words=None):
+    """What share of common English words (assets/common_words.txt) have been said at least once."""
+    words = common_words() if words is None else words
+    said = {w for w, in conn.execute(
+        f"SELECT word FROM word_freq WHERE word IN ({','.join('?' * len(words))})", words
+    )} if words else set()
+    return {
+        "common": len(words),
+        "available": len(said),
+        "share": len(said) / len(words) if words else None,
+        "missing": [w for w in words if w not in said],
+    }
+
+
+def summary(conn, limit=10):
+    """Everything the /stats endpoint shows."""
+    words, videos = conn.execute("SELECT COALESCE(SUM(words), 0), COUNT(*) FROM video_word_counts").fetchone()
+    return {
+        "words": words,
+        "unique_words": conn.execute("SELECT COUNT(*) FROM word_freq").fetchone()[0],
+        "videos": videos,
+        "top_words": top_words(conn, limit),
+        "top_ngrams": {n: top_ngrams(conn, n, limit) for n in NGRAM_SIZES},
+        "coverage": coverage(conn),
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    import ingest
+
+    conn = ingest.connect(DB_PATH)
+    args = sys.argv[1:] or ["top"]
+    cmd = args[0]
+    if cmd == "top":
+        n = int(args[1]) if len(args) > 1 else 10
+        print(f"🔥 Top {n} Most Common Words:")
+        for rank, (word, freq) in enumerate(top_words(conn, n), start=1):
+            print(f"{rank}. “{word}” — {freq} occurrences")
+    elif cmd == "ngrams":
+        n = int(args[1]) if len(args) > 1 else 2
+        for rank, (gram, freq) in enumerate(top_ngrams(conn, n, int(args[2]) if len(args) > 2 else 10), start=1):
+            print(f"{rank}. “{gram}” — {freq} occurrences")
+    elif cmd == "word" and len(args) > 1:
+        count, videos = word_count(conn, args[1])
+        print(f"“{args[1]}” was said {count} times in {videos} videos.")
+    elif cmd == "coverage":
+        cov = coverage(conn)
+        if cov["share"] is None:
+            print(f"⚠️ No common words list at {COMMON_WORDS}")
+        else:
+            print(f"📚 {cov['available']}/{cov['common']} common words available ({cov['share']:.1%}).")
+            if cov["missing"]:
+                print("Missing: " + ", ".join(cov["missing"]))
+    elif cmd == "rebuild":
+        rebuild(conn.cursor())
+        conn.commit()
+        print("✅ Stats rebuilt.")
+    elif cmd == "json":
+        print(json.dumps(summary(conn), indent=2))
+    else:
+        print("Usage: python stats.py [top N | ngrams N LIMIT | word W | coverage | rebuild | json]")
+    conn.close()
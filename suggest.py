@@ -0,0 +1,172 @@
+import copy, heapq, os
+from bisect import bisect_left
+
+# How far (in Damerau-Levenshtein edits) a suggestion may be from the typed
+# word. Words this short or shorter only get one edit, or everything matches.
+MAX_EDIT = int(os.getenv("SUGGEST_MAX_EDIT", 2))
+SHORT_WORD = 4
+# Deletes are only generated for this many leading characters (the SymSpell
+# prefix trick), which keeps the table small without losing many matches.
+PREFIX_LENGTH = 7
+
+_SOUNDEX = {c: d for d, letters in enumerate(("bfpv", "cgjkqsxz", "dt", "l", "mn", "r"), 1) for c in letters}
+
+
+def phonetic(word):
+    """Soundex over the whole word: the first letter, then consonant classes with repeats collapsed."""
+    word = "".join(c for c in word.lower() if c.isalpha())
+    if not word:
+        return ""
+    key, last = [word[0]], _SOUNDEX.get(word[0])
+    for c in word[1:]:
+        code = _SOUNDEX.get(c)
+        if code is not None and code != last:
+            key.append(str(code))
+        if c not in "hw":
+            last = code
+    return "".join(key)
+
+
+def _deletes(term, depth):
+    """`term` plus every string made by removing up to `depth` characters from it."""
+    found = {term}
+    frontier = {term}
+    for _ in range(depth):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))} - found
+        found |= frontier
+    return found
+
+
+def distance(a, b, limit):
+    """Optimal string alignment distance between `a` and `b`, or limit + 1 once it's known to exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], before[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        before, prev = prev, cur
+    return prev[-1]
+
+
+class Suggester:
+    """
+    Spelling suggestions over the spoken vocabulary, built from a WordIndex:
+    a sorted array for prefix completion, a SymSpell-style table of deletes
+    for edit-distance candidates and a Soundex table for words that sound
+    alike but are spelled further apart. `extend` brings it up to date with
+    a newer generation without rebuilding the tables.
+    """
+
+    def __init__(self, index, counts=None, max_edit=MAX_EDIT, prefix_length=PREFIX_LENGTH):
+        self.max_edit = max_edit
+        self.prefix_length = prefix_length
+        self.words = list(index)  # already sorted
+        # `counts` (word -> times said, e.g. stats.frequencies) saves asking the index per word.
+        # Only words in here are still spoken; the tables may hold a few that aren't anymore.
+        self.counts = {w: counts.get(w, 0) for w in self.words} if counts else {w: index.count(w) for w in self.words}
+        # (deletes, sound-alikes) tables, oldest first; extend adds one for the words it brings.
+        self._tables = [self._build(self.words)]
+
+    def _build(self, words):
+        deletes, sounds = {}, {}
+        for word in words:
+            for d in _deletes(word[:self.prefix_length], self.max_edit):
+                deletes.setdefault(d, []).append(word)
+            sounds.setdefault(phonetic(word), []).append(word)
+        return deletes, sounds
+
+    def extend(self, index, changed):
+        """
+        This suggester for `index`, a newer generation in which the words
+        `changed` gained or lost occurrences. They get fresh counts; only
+        the ones that weren't spoken before get deletes and sound keys
+        generated, in a table of their own, and the rest are shared with
+        this suggester rather than copied.
+        """
+        counts, added, gone = dict(self.counts), [], False
+        for word in changed:
+            n = index.count(word)
+            if n:
+                if word not in counts:
+                    added.append(word)
+                counts[word] = n
+            elif counts.pop(word, None) is not None:
+                gone = True
+        added.sort()
+
+        new = copy.copy(self)
+        new.counts = counts
+        new.words = list(heapq.merge(self.words, added))
+        if gone:
+            new.words = [w for w in new.words if w in counts]
+        new._tables = self._tables + [self._build(added)] if added else self._tables
+        return new
+
+    def _candidates(self, table, key):
+        # Every table can name a word, and older ones words that aren't said anymore.
+        for tables in self._tables:
+            for word in tables[table].get(key, ()):
+                if word in self.counts:
+                    yield word
+
+    def _prefix_range(self, prefix):
+        return bisect_left(self.words, prefix), bisect_left(self.words, prefix + "\U0010ffff")
+
+    def _completions(self, prefix, limit):
+        lo, hi = self._prefix_range(prefix)
+        return heapq.nlargest(limit, self.words[lo:hi], key=self.counts.__getitem__)
+
+    def complete(self, prefix, limit=5):
+        """The `limit` most spoken words starting with `prefix`, as (word, count)."""
+        return [(w, self.counts[w]) for w in self._completions(prefix.lower(), limit)]
+
+    def suggest(self, word, limit=5):
+        """
+        The closest spoken alternatives to `word`, as dicts with 'word',
+        'count' and 'distance'. Ordered by edit distance, then by how often
+        the word was said; sound-alikes and completions fill any space left.
+        """
+        word = word.lower()
+        max_edit = min(self.max_edit, 1) if len(word) <= SHORT_WORD else self.max_edit
+        scored = {}
+        for d in _deletes(word[:self.prefix_length], max_edit):
+            for w in self._candidates(0, d):
+                if w not in scored:
+                    scored[w] = distance(word, w, max_edit)
+        matches = [(dist, -self.counts[w], w) for w, dist in scored.items() if 0 < dist <= max_edit]
+
+        if len(matches) < limit:
+            # Sound-alikes may be one edit further away than spelling matches.
+            for w in self._candidates(1, phonetic(word)):
+                if w not in scored:
+                    scored[w] = distance(word, w, max_edit + 1)
+                    if scored[w] <= max_edit + 1:
+                        matches.append((scored[w], -self.counts[w], w))
+        if len(matches) < limit:
+            # Completions are usually too long to be an edit match, but may have been scored as one.
+            matched = {w for *_, w in matches}
+            for w in self._completions(word, limit):
+                if w not in matched and w != word:
+                    matches.append((len(w) - len(word), -self.counts[w], w))
+
+        return [
+            {"word": w, "count": -neg_count, "distance": dist}
+            for dist, neg_count, w in heapq.nsmallest(limit, matches)
+        ]
+
+
+if __name__ == "__main__":
+    import sys, time
+    from vocabulary import suggester
+
+    for word in sys.argv[1:]:
+        start = time.perf_counter()
+        suggestions = suggester.suggest(word)
+        took = (time.perf_counter() - start) * 1000
+        print(f"{word}: " + ", ".join(f"{s['word']} ({s['count']})" for s in suggestions) + f"  [{took:.2f}ms]")
@@ -0,0 +1,27 @@
+import os, sys
+import pytest
+
+# The modules live at the repo root, next to this folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db, ingest
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "new.db")
+    ingest.connect(path).close()
+    yield path
+    db.close_all()
+
+
+@pytest.fixture
+def add_video(db_path):
+    """Ingests (or re-ingests) a video whose words are said back to back, 0.5s each."""
+    def add(video_id, text, gap=0.1):
+        words = [(video_id, w, i * 0.5 + gap, (i + 1) * 0.5, 0.9, 0.1) for i, w in enumerate(text.split())]
+        conn = db.connect(db_path)
+        conn.execute("DELETE FROM videos WHERE video_id = ?", (video_id,))
+        ingest.write_batch(conn, [(video_id, [(video_id, text, words[0][2], words[-1][3])], words, {"status": "ok", "height": 720})])
+        conn.close()
+    return add
@@ -0,0 +1,116 @@
+"""Index generations: delta layers on top of the base file, and hot reload."""
+import threading
+import pytest
+import compact_index, db, vocabulary
+from suggest import Suggester
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / "index.bin")
+
+
+@pytest.fixture
+def reload(db_path, index_path, monkeypatch):
+    monkeypatch.setattr(vocabulary, "_current", None)
+    return lambda: vocabulary.refresh(db_path, index_path)
+
+
+def test_new_videos_load_as_a_delta(db_path, add_video, reload):
+    add_video("v1", "the cat sat")
+    first = reload()
+    assert first.index.deltas == ()
+    assert "dog" not in first.index
+
+    add_video("v2", "the dog sat")
+    gen = reload()
+    assert gen.number > first.number
+    assert len(gen.index.deltas) == 1
+    assert gen.index.deltas[0].video_ids() == ["v2"]  # only the new video was read
+    assert gen.index.count("the") == 2
+    assert [e["video_id"] for e in gen.index["dog"]] == ["v2"]
+    assert gen.suggester.suggest("dgo")[0]["word"] == "dog"
+    # The old generation is untouched, so in-flight requests keep their snapshot.
+    assert "dog" not in first.index
+    assert reload() is gen  # nothing new
+
+
+def test_reingested_video_replaces_its_old_rows(db_path, add_video, reload):
+    add_video("v1", "the cat sat on the mat")
+    add_video("v2", "the dog sat")
+    reload()
+    add_video("v1", "a cat sat")
+    idx = reload().index
+
+    assert "mat" not in idx
+    assert "mat" not in list(idx)
+    assert len(idx) == len(list(idx)) == len({"the", "dog", "a", "cat", "sat"})
+    assert "a" in idx
+    assert idx.count("the") == 1
+    assert {e["video_id"] for e in idx["sat"]} == {"v1", "v2"}
+    assert [(i, j) for i, j, _ in vocabulary.plan_sentence(["a", "cat", "sat"], idx)] == [(0, 3)]
+    with pytest.raises(Exception, match="mat"):
+        vocabulary.plan_sentence(["the", "mat"], idx)
+    assert "mat" not in [s["word"] for s in reload().suggester.suggest("mat")]
+
+
+def test_deltas_extend_the_suggester(db_path, add_video, reload):
+    add_video("v1", "the cat sat on the mat")
+    add_video("v2", "the dog sat")
+    first = reload()
+    add_video("v3", "a catalog of dogs")
+    add_video("v1", "the cat sat")  # "mat" and "on" aren't said anymore
+    gen = reload()
+
+    assert gen.suggester._tables[0] is first.suggester._tables[0]  # shared, not rebuilt
+    fresh = Suggester(gen.index, vocabulary._frequencies(db_path))
+    assert gen.suggester.words == fresh.words
+    assert gen.suggester.counts == fresh.counts
+    for word in ("mat", "dgo", "cta", "ca", "catalgo"):
+        assert gen.suggester.suggest(word) == fresh.suggest(word)
+    assert "mat" not in [s["word"] for s in gen.suggester.suggest("mat")]
+    assert "mat" in [s["word"] for s in first.suggester.suggest("maat")]  # the old generation keeps its own
+
+
+def test_published_base_replaces_deltas(db_path, add_video, reload, index_path):
+    add_video("v1", "the cat sat")
+    reload()
+    add_video("v2", "the dog sat")
+    assert len(reload().index.deltas) == 1
+    compact_index.build(db_path, index_path)  # what update_db does at the end of a run
+    gen = reload()
+    assert gen.index.deltas == ()
+    assert gen.index.count("the") == 2
+
+
+def test_too_many_deltas_rebuilds_the_base(db_path, add_video, reload, monkeypatch):
+    monkeypatch.setattr(vocabulary, "MAX_DELTAS", 2)
+    add_video("v0", "start")
+    reload()
+    for i in range(1, 4):
+        add_video(f"v{i}", f"word{i}")
+        gen = reload()
+    assert gen.index.deltas == ()
+    assert all(f"word{i}" in gen.index for i in range(1, 4))
+
+
+def test_background_reloads_reuse_one_connection(db_path, add_video, reload, index_path, monkeypatch):
+    add_video("v1", "the cat sat")
+    reload()
+    monkeypatch.setattr(vocabulary, "RELOAD_INTERVAL", 0)
+    monkeypatch.setattr(vocabulary, "_refresh", lambda: vocabulary.refresh(db_path, index_path))
+    for _ in range(20):
+        vocabulary.current()
+        vocabulary._reloader.submit(lambda: None).result()  # wait for the check to finish
+    assert len(db._open) <= 2  # this thread's reader and the reload thread's
+
+
+def test_readers_of_exited_threads_are_closed(db_path):
+    def read():
+        db.query("SELECT 1", db_path=db_path)
+    for _ in range(10):
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+    read()
+    assert len(db._open) == 1
@@ -0,0 +1,130 @@
+"""Offline checks for the download stage: manifest states, retries and partial-file cleanup."""
+import os, threading
+import pytest
+import db, ingest
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = ingest.connect(str(tmp_path / "new.db"))
+    yield conn
+    conn.close()
+    db.close_all()
+
+
+@pytest.fixture
+def sources(tmp_path):
+    src = tmp_path / "sources"
+    src.mkdir()
+    for vid in ("aaa", "bbb", "ccc"):
+        (src / f"{vid}.mp4").write_bytes(vid.encode() * 100)
+    return str(src)
+
+
+def manifest(conn):
+    rows = conn.execute("SELECT video_id, state, attempts, size, checksum FROM manifest").fetchall()
+    return {vid: (state, attempts, size, checksum) for vid, state, attempts, size, checksum in rows}
+
+
+def test_manifest_states(conn, sources, tmp_path):
+    out = str(tmp_path / "downloads")
+    shorts = [("aaa", 10), ("bbb", 20), ("ccc", 30)]
+    results = dict(ingest.download(conn, shorts, ingest.FakeDownloader(sources, fail={"ccc"}), retries=2, backoff=0, download_dir=out))
+
+    assert results["aaa"] is None and results["bbb"] is None
+    assert isinstance(results["ccc"], ingest.DownloadError)
+    rows = manifest(conn)
+    assert rows["aaa"][:3] == ("downloaded", 1, 300)
+    assert rows["aaa"][3] == ingest._checksum(os.path.join(out, "aaa.mp4"))
+    assert rows["ccc"][:2] == ("failed", 3)
+    assert not os.path.exists(os.path.join(out, "ccc.mp4"))
+
+
+def test_resume_skips_downloaded_and_adopts_existing(conn, sources, tmp_path):
+    out = str(tmp_path / "downloads")
+    list(ingest.download(conn, [("aaa", 10)], ingest.FakeDownloader(sources), download_dir=out))
+    # Already on disk before the manifest knew about it.
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(out, "bbb.mp4"), "wb") as f:
+        f.write(b"local")
+
+    calls = []
+    def downloader(video_id, out_path):
+        calls.append(video_id)
+        ingest.FakeDownloader(sources)(video_id, out_path)
+
+    results = dict(ingest.download(conn, [("aaa", 10), ("bbb", 20), ("ccc", 30)], downloader, download_dir=out))
+    assert results == {"aaa": None, "bbb": None, "ccc": None}
+    assert calls == ["ccc"]
+    assert manifest(conn)["bbb"][:3] == ("downloaded", 0, 5)
+
+
+def test_local_files_overlap_with_downloads(conn, sources, tmp_path):
+    out = str(tmp_path / "downloads")
+    list(ingest.download(conn, [("aaa", 10)], ingest.FakeDownloader(sources), download_dir=out))
+
+    started = threading.Event()
+    def downloader(video_id, out_path):
+        started.set()
+        ingest.FakeDownloader(sources)(video_id, out_path)
+
+    results = ingest.download(conn, [("aaa", 10), ("bbb", 20)], downloader, download_dir=out)
+    assert next(results) == ("aaa", None)
+    # The caller is still busy with the local file, but "bbb" is already downloading.
+    assert started.wait(5)
+    assert list(results) == [("bbb", None)]
+
+
+def test_retry_with_backoff(conn, sources, tmp_path, monkeypatch):
+    out = str(tmp_path / "downloads")
+    sleeps = []
+    monkeypatch.setattr(ingest.time, "sleep", sleeps.append)
+    attempts = []
+    def flaky(video_id, out_path):
+        attempts.append(video_id)
+        if len(attempts) < 3:
+            raise ingest.DownloadError("HTTP Error 503")
+        ingest.FakeDownloader(sources)(video_id, out_path)
+
+    assert list(ingest.download(conn, [("aaa", 10)], flaky, retries=3, backoff=0.5, download_dir=out)) == [("aaa", None)]
+    assert sleeps == [0.5, 1.0]
+    assert manifest(conn)["aaa"][:2] == ("downloaded", 3)
+
+
+def test_non_retryable_error_fails_once(conn, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest.time, "sleep", lambda s: pytest.fail("should not back off"))
+    def blocked(video_id, out_path):
+        raise ingest.DownloadError("Video may be inappropriate for some users.", retryable=False)
+
+    [(vid, error)] = ingest.download(conn, [("aaa", 10)], blocked, retries=3, download_dir=str(tmp_path / "downloads"))
+    assert not error.retryable
+    assert manifest(conn)["aaa"][:2] == ("failed", 1)
+
+
+def test_partial_files_are_cleaned_up(conn, sources, tmp_path, monkeypatch):
+    out = str(tmp_path / "downloads")
+    monkeypatch.setattr(ingest.time, "sleep", lambda s: None)
+    seen = []
+    def partial(video_id, out_path):
+        # What an interrupted yt-dlp leaves behind: format parts and a truncated output.
+        seen.append(sorted(os.listdir(out)))
+        if len(seen) == 1:
+            for name in (f"{video_id}.f137.mp4.part", f"{video_id}.f140.m4a"):
+                open(os.path.join(out, name), "wb").close()
+            with open(out_path, "wb") as f:
+                f.write(b"trunc")
+            raise ingest.DownloadError("Connection reset")
+        ingest.FakeDownloader(sources)(video_id, out_path)
+
+    assert list(ingest.download(conn, [("aaa", 10)], partial, retries=1, download_dir=out)) == [("aaa", None)]
+    assert seen[1] == []  # the retry started from a clean slate
+    assert sorted(os.listdir(out)) == ["aaa.mp4"]
+
+
+def test_empty_output_counts_as_failure(conn, tmp_path):
+    def nothing(video_id, out_path):
+        pass
+
+    [(vid, error)] = ingest.download(conn, [("aaa", 10)], nothing, retries=0, download_dir=str(tmp_path / "downloads"))
+    assert "without producing a file" in str(error)
+    assert manifest(conn)["aaa"][0] == "failed"
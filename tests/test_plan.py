@@ -0,0 +1,45 @@
+"""The DP sentence planner over the positional word index."""
+import pytest
+import compact_index, vocabulary
+
+
+@pytest.fixture
+def index(db_path, add_video, tmp_path):
+    add_video("v1", "the cat sat on a hat")
+    add_video("v2", "on the mat the dog slept")
+    add_video("v3", "cat")
+    def load():
+        return compact_index.load(db_path, str(tmp_path / "index.bin"))
+    return load
+
+
+def test_single_video_covers_whole_sentence(index):
+    [(i, j, match)] = vocabulary.plan_sentence(["the", "cat", "sat"], index())
+    assert (i, j) == (0, 3)
+    video_id, start, end = match
+    assert video_id == "v1"
+    assert (start, end) == pytest.approx((0.1, 1.5))  # first word's start to last word's end
+
+
+def test_fewest_cuts(index):
+    words = "the cat sat on the mat".split()
+    plan = vocabulary.plan_sentence(words, index())
+    assert [(i, j) for i, j, _ in plan] == [(0, 3), (3, 6)]
+    assert [m[0] for _, _, m in plan] == ["v1", "v2"]
+
+
+def test_plan_covers_sentence_in_order(index):
+    words = "the dog sat on a mat".split()
+    plan = vocabulary.plan_sentence(words, index())
+    assert plan[0][0] == 0 and plan[-1][1] == len(words)
+    assert all(a[1] == b[0] for a, b in zip(plan, plan[1:]))
+    assert [(i, j) for i, j, _ in plan] == [(0, 2), (2, 5), (5, 6)]  # "the dog" | "sat on a" | "mat"
+
+
+def test_missing_words(index):
+    words = "the zebra sat".split()
+    with pytest.raises(Exception, match="zebra"):
+        vocabulary.plan_sentence(words, index())
+    plan = vocabulary.plan_sentence(words, index(), allow_missing=True)
+    assert plan[1] == (1, 2, None)
+    assert plan[0][2] is not None and plan[2][2] is not None
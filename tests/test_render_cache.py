@@ -0,0 +1,65 @@
+"""The finished-render cache: keys, TTL, byte budget and files that went missing."""
+import os
+import render_cache
+from render_cache import RenderCache, make_key
+
+
+def sel(video_id, start, end):
+    return {"video_id": video_id, "start": start, "end": end}
+
+
+def test_key_covers_sentence_clips_and_settings():
+    key = make_key(["hi"], [sel("a", 0.1, 0.5)], {"fps": 30})
+    assert key == make_key(["hi"], [sel("a", 0.1000001, 0.5)], {"fps": 30})
+    assert key != make_key(["hi"], [sel("b", 0.1, 0.5)], {"fps": 30})
+    assert key != make_key(["hi"], [sel("a", 0.1, 0.5)], {"fps": 24})
+    assert key != make_key(["ho"], [sel("a", 0.1, 0.5)], {"fps": 30})
+
+
+def test_put_and_get(tmp_path):
+    cache = RenderCache(root=str(tmp_path))
+    assert cache.get("k") is None
+    cache.put("k", b"video")
+    assert cache.get("k") == b"video"
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    cache = RenderCache(root=str(tmp_path), ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr(render_cache.time, "time", lambda: now[0])
+    cache.put("k", b"video")
+    now[0] += 59
+    assert cache.get("k") == b"video"
+    now[0] += 2
+    assert cache.get("k") is None
+    assert not os.path.exists(cache._path("k"))
+
+
+def test_budget_evicts_least_recently_used(tmp_path, monkeypatch):
+    cache = RenderCache(root=str(tmp_path), budget=10)
+    now = [1000.0]
+    monkeypatch.setattr(render_cache.time, "time", lambda: now[0])
+    for key in ("a", "b"):
+        now[0] += 1
+        cache.put(key, b"12345")
+    now[0] += 1
+    assert cache.get("a") == b"12345"  # b is now the least recently used
+    now[0] += 1
+    cache.put("c", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") == cache.get("c") == b"12345"
+
+
+def test_oversized_renders_are_not_cached(tmp_path):
+    cache = RenderCache(root=str(tmp_path), budget=4)
+    cache.put("k", b"12345")
+    assert cache.get("k") is None
+
+
+def test_missing_file_is_a_miss(tmp_path):
+    cache = RenderCache(root=str(tmp_path))
+    cache.put("k", b"video")
+    os.remove(cache._path("k"))
+    assert cache.get("k") is None
+    assert cache._conn.execute("SELECT COUNT(*) FROM renders").fetchone()[0] == 0
@@ -0,0 +1,106 @@
+"""RenderScheduler's queueing: limits, queue positions, cancellation and slot release."""
+import asyncio, time
+import pytest
+from scheduler import RenderScheduler, QueueFull
+
+
+# Jobs run in spawned worker processes, so they have to be importable module-level functions.
+def job(value, emit, delay=0.0):
+    emit("progress", {"step": "working"})
+    time.sleep(delay)
+    return value
+
+
+def until_cancelled(emit):
+    emit("progress", {"step": "working"})
+    deadline = time.monotonic() + 30
+    while not emit.cancelled() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return emit.cancelled()
+
+
+@pytest.fixture
+def scheduler():
+    s = RenderScheduler(workers=1, max_queue=1)
+    yield s
+    s.shutdown()
+
+
+async def collect(events):
+    return [item async for item in events]
+
+
+def test_runs_job_and_yields_its_events(scheduler):
+    events = asyncio.run(collect(scheduler.run(job, 42)))
+    assert events == [("progress", {"step": "working"}), ("result", 42)]
+    assert scheduler.running == 0
+
+
+def test_queue_positions_and_queue_full(scheduler):
+    async def main():
+        first = scheduler.run(job, 1, delay=1.0)
+        assert await first.__anext__() == ("progress", {"step": "working"})
+
+        second = scheduler.run(job, 2)
+        assert await second.__anext__() == ("progress", {"step": "queued", "position": 1})
+        assert scheduler.depth == 1
+
+        with pytest.raises(QueueFull):
+            await scheduler.run(job, 3).__anext__()
+
+        assert (await collect(first))[-1] == ("result", 1)
+        assert (await collect(second))[-1] == ("result", 2)
+        assert (scheduler.running, scheduler.depth) == (0, 0)
+    asyncio.run(main())
+
+
+def test_early_close_cancels_job_and_releases_slot(scheduler):
+    async def main():
+        events = scheduler.run(until_cancelled)
+        await events.__anext__()  # running, holding the only slot
+        waiting = scheduler.run(job, "next")
+        assert await waiting.__anext__() == ("progress", {"step": "queued", "position": 1})
+
+        await events.aclose()  # the caller went away
+        assert scheduler.running == 1  # handed straight to the waiting job
+        assert (await collect(waiting))[-1] == ("result", "next")
+        assert scheduler.running == 0
+    asyncio.run(main())
+
+
+def test_leaving_the_queue_frees_its_place(scheduler):
+    async def main():
+        first = scheduler.run(job, 1, delay=0.5)
+        await first.__anext__()
+        waiting = scheduler.run(job, 2)
+        await waiting.__anext__()
+        await waiting.aclose()
+        assert scheduler.depth == 0
+        assert (await collect(first))[-1] == ("result", 1)
+        assert scheduler.running == 0
+    asyncio.run(main())
+
+
+def test_idle_jobs_only_take_a_free_worker(scheduler):
+    async def main():
+        first = scheduler.run(job, 1, delay=0.5)
+        await first.__anext__()
+        with pytest.raises(QueueFull):
+            await scheduler.run_idle(job, 2).__anext__()
+        await collect(first)
+        assert (await collect(scheduler.run_idle(job, 3)))[-1] == ("result", 3)
+        assert scheduler.idle_running == 0
+    asyncio.run(main())
+
+
+def test_queued_job_preempts_idle_one(scheduler):
+    async def main():
+        idle = scheduler.run_idle(until_cancelled)
+        await idle.__anext__()  # warming, on the only worker
+        real = scheduler.run(job, "real")
+        assert await real.__anext__() == ("progress", {"step": "queued", "position": 1})
+
+        assert (await collect(idle))[-1] == ("result", True)  # told to stop
+        assert (await collect(real))[-1] == ("result", "real")
+        assert (scheduler.running, scheduler.idle_running) == (0, 0)
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+"""Incremental corpus statistics stay equal to a full rebuild."""
+import db, stats
+
+
+def snapshot(conn):
+    return {
+        table: sorted(conn.execute(f"SELECT * FROM {table}").fetchall())
+        for table in ("word_freq", "video_word_counts", "ngram_freq")
+    }
+
+
+def rebuilt(db_path):
+    conn = db.connect(db_path)
+    try:
+        stats.rebuild(conn.cursor())
+        return snapshot(conn)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_counts_follow_ingest(db_path, add_video):
+    add_video("v1", "the cat sat on the mat")
+    add_video("v2", "the dog sat")
+    conn = db.reader(db_path)
+
+    assert stats.word_count(conn, "the") == (3, 2)
+    assert stats.word_count(conn, "Sat!") == (2, 2)
+    assert stats.word_count(conn, "zebra") == (0, 0)
+    assert dict(stats.top_ngrams(conn, 2))["the cat"] == 1
+    assert dict(stats.top_ngrams(conn, 3))["cat sat on"] == 1
+    assert stats.summary(conn)["words"] == 9
+    assert snapshot(conn) == rebuilt(db_path)
+
+
+def test_reingest_replaces_old_counts(db_path, add_video):
+    add_video("v1", "the cat sat on the mat")
+    add_video("v2", "the dog sat")
+    add_video("v1", "a cat sat")  # re-transcribed
+    conn = db.reader(db_path)
+
+    assert stats.word_count(conn, "mat") == (0, 0)
+    assert stats.word_count(conn, "the") == (1, 1)
+    assert stats.word_count(conn, "sat") == (2, 2)
+    assert "the cat" not in dict(stats.top_ngrams(conn, 2, 100))
+    assert stats.summary(conn)["videos"] == 2
+    assert snapshot(conn) == rebuilt(db_path)
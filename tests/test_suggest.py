@@ -0,0 +1,56 @@
+"""Spelling suggestions for words that were never said."""
+from suggest import Suggester, distance, phonetic
+
+
+def suggester(counts):
+    return Suggester(sorted(counts), counts)
+
+
+def words(suggestions):
+    return [s["word"] for s in suggestions]
+
+
+def test_distance():
+    assert distance("cat", "cat", 2) == 0
+    assert distance("cat", "act", 2) == 1  # a transposition is one edit
+    assert distance("cat", "cart", 2) == 1
+    assert distance("cat", "dog", 1) == 2  # capped at limit + 1
+
+
+def test_phonetic():
+    assert phonetic("Robert") == phonetic("rupert") == "r163"
+
+
+def test_ranked_by_distance_then_count():
+    s = suggester({"cat": 10, "cab": 50, "car": 1, "cast": 500, "dog": 100})
+    got = s.suggest("caz")
+    assert words(got) == ["cab", "cat", "car"]
+    assert got[0] == {"word": "cab", "count": 50, "distance": 1}
+    assert "dog" not in words(got)
+    assert words(s.suggest("caz", limit=2)) == ["cab", "cat"]
+
+
+def test_exact_word_is_not_suggested():
+    assert "cat" not in words(suggester({"cat": 1, "cab": 1}).suggest("cat"))
+
+
+def test_short_words_get_one_edit():
+    s = suggester({"cat": 1, "catalog": 1})
+    assert words(s.suggest("cxy")) == []  # two edits from "cat", but it's a short word
+    assert words(s.suggest("catxlxg")) == ["catalog"]  # two edits is fine for longer ones
+
+
+def test_sound_alikes_fill_in():
+    s = suggester({"fonetik": 3, "zebra": 1})
+    assert words(s.suggest("phonetic")) == []  # too far by spelling, and sounds different
+    s = suggester({"nite": 3})
+    assert words(s.suggest("knight")) == []
+    s = suggester({"rupert": 3})
+    assert s.suggest("robert") == [{"word": "rupert", "count": 3, "distance": 2}]
+
+
+def test_completions_fill_in():
+    s = suggester({"elephant": 2, "elephants": 9, "elk": 1})
+    assert words(s.suggest("eleph")) == ["elephant", "elephants"]  # closest completion first
+    assert s.complete("eleph") == [("elephants", 9), ("elephant", 2)]
+    assert s.complete("zz") == []
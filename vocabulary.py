@@ -1,35 +1,205 @@
-import sqlite3, os, string
-from collections import defaultdict
+import sqlite3, os, string, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import compact_index, db, stats
+from suggest import Suggester
 
-DB_PATH = "new.db"
-conn = sqlite3.connect(DB_PATH)
-c    = conn.cursor()
+DB_PATH = os.getenv("DB_PATH", "new.db")
+DOWNLOAD_DIR = "downloads"
 
-c.execute("SELECT video_id, word, start, end FROM words")
-vocab = c.fetchall()
-conn.close()
+# How often a running process checks new.db for a newer index generation.
+RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", 5))
+# Past this many delta layers, the next reload rebuilds (and republishes) the base file.
+MAX_DELTAS = int(os.getenv("INDEX_MAX_DELTAS", 16))
 
-vocab_list = [a[1].strip().lower().strip(string.punctuation) for a in vocab]
+def _frequencies(db_path):
+    # Materialized by ingest; a database that predates it just gets None.
+    try:
+        return stats.frequencies(db.reader(db_path))
+    except sqlite3.OperationalError:
+        return None
 
-DOWNLOAD_DIR = "downloads"
+class Generation:
+    """
+    One consistent view of the corpus: the word index (word -> list of
+    {"video_id", "video_path", "start", "end", "score"}) and the suggester
+    built from it. Hold on to one for the length of a request.
+    """
+
+    def __init__(self, index, db_path=DB_PATH, previous=None):
+        self.index = index
+        self.number = index.generation
+        # Closest spoken alternatives for words that are missing from the index.
+        # A generation that only adds delta layers to `previous` updates its
+        # suggester with the words they touch; a new base gets a fresh one.
+        if previous is not None and index.base is previous.index.base and index.deltas[:len(previous.index.deltas)] == previous.index.deltas:
+            self.suggester = previous.suggester.extend(index, index.changed_words(previous.index))
+        else:
+            self.suggester = Suggester(index, _frequencies(db_path))
+
+# Loaded on first use (or by app's warm-up), not at import.
+_current = None
+_checked = time.monotonic()
+_reloading = threading.Lock()
+# Background checks all run on this one long-lived thread, which keeps its pooled reader.
+_reloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-reload")
+
+def ready():
+    """True once the first generation is loaded, so current() won't block."""
+    return _current is not None
+
+def refresh(db_path=DB_PATH, path=compact_index.INDEX_PATH):
+    """
+    Swaps in the newest generation, if ingest published one: a newer base
+    file if someone rebuilt it, plus a delta layer of the videos added
+    since. Loads the first generation if there isn't one yet. Returns the
+    current generation.
+    """
+    global _current
+    with _reloading:
+        if _current is None:
+            _current = Generation(compact_index.load(db_path, path), db_path)
+            return _current
+        gen = _current
+        index = gen.index
+        if compact_index.peek(path) > index.base.generation:
+            index = compact_index.load(db_path, path)
+        elif compact_index.generation(db.reader(db_path)) > index.generation:
+            if len(index.deltas) >= MAX_DELTAS:
+                index = compact_index.LayeredIndex(compact_index.WordIndex(compact_index.build(db_path, path)))
+            else:
+                index = index.extend(compact_index.build_delta(db_path, index.generation))
+        if index is not gen.index:
+            _current = Generation(index, db_path, gen)
+            print(f"📦 Index generation {gen.number} → {_current.number}")
+        return _current
+
+def _refresh():
+    try:
+        refresh()
+    except Exception as e:
+        print(f"⚠️ Index reload failed: {e}")
+
+def current():
+    """
+    The newest loaded generation. Every RELOAD_INTERVAL seconds this also
+    starts a background check for a newer one; callers never wait on it.
+    Only the very first call (if nothing warmed up the index) loads it in
+    the caller's thread.
+    """
+    global _checked
+    if _current is None:
+        return refresh()
+    now = time.monotonic()
+    if now - _checked >= RELOAD_INTERVAL and not _reloading.locked():
+        _checked = now
+        _reloader.submit(_refresh)
+    return _current
+
+def __getattr__(name):
+    # The module-level names older code imports, always for the newest generation.
+    if name == "word_index":
+        return current().index
+    if name == "suggester":
+        return current().suggester
+    # Every spoken word occurrence, in DB order. Only built if someone asks.
+    if name == "vocab_list":
+        rows = db.query("SELECT word FROM words")
+        globals()["vocab_list"] = [w.strip().lower().strip(string.punctuation) for w, in rows]
+        return globals()["vocab_list"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+_translator = str.maketrans('', '', string.punctuation)
+
+def clean_sentence(sentence):
+    """Lowercases the sentence, strips punctuation and splits it into words."""
+    return [word for word in sentence.strip().lower().translate(_translator).split() if word]
+
+def _index_for(db_path):
+    if db_path == DB_PATH:
+        return current().index
+    return compact_index.load(db_path, os.path.splitext(db_path)[0] + ".index.bin")
+
+def plan_sentence(words, index=None, allow_missing=False):
+    """
+    Finds the cheapest way to cover `words` with clips from the corpus.
 
-word_index = defaultdict(list)
-for video_id, word, start, end in vocab:
-    word = word.strip().lower()  # normalize
-    video_path = os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4")
-    word_index[word].append({
-        "video_path": video_path,
-        "start":       start,
-        "end":         end
-    })
+    Every run of words said back to back in one video is a candidate clip. A
+    single pass over the index finds, for each start position, every run
+    length that exists and the cleanest occurrence of it. Dynamic programming
+    then picks the covering with the fewest cuts, breaking ties by total cut
+    quality (silence around the clip boundaries).
+
+    Args:
+        words: The cleaned words of the sentence.
+        index: The index to search (a WordIndex or a generation's
+               LayeredIndex), defaults to the current generation's.
+        allow_missing: If True, words that were never said become their own
+                       (None) step instead of raising.
+
+    Returns:
+        A list of (i, j, match) tuples covering words[i:j] in order, where
+        match is (video_id, start, end), or None for a missing word.
+
+    Raises:
+        Exception: If a word can't be found and `allow_missing` is False.
+    """
+    index = current().index if index is None else index
+    n = len(words)
+
+    # runs[i][length] = (quality, layer, corpus position of the best occurrence in it)
+    runs = [{} for _ in range(n)]
+    for layer_no, (layer, skip) in enumerate(index.layers):
+        ids = [layer.word_id(w) for w in words]
+        for i, word_id in enumerate(ids):
+            if word_id is None:
+                continue
+            live = [p for p in layer.positions(word_id) if not skip or layer.video_at(p) not in skip]
+            length = 1
+            while live:
+                found = max((layer.cut_quality(p, length), layer_no, p) for p in live)
+                runs[i][length] = max(runs[i].get(length, found), found)
+                if i + length >= n or ids[i + length] is None:
+                    break
+                live = [p for p in live if layer.extends(p, length, ids[i + length])]
+                length += 1
+    if not allow_missing:
+        for i in range(n):
+            if not runs[i]:
+                raise Exception(f"Word '{words[i]}' (from original sentence position {i+1}) not found in the database.")
+
+    # best[j] = (cuts, -quality, previous j, run length) for covering words[:j]
+    best = [None] * (n + 1)
+    best[0] = (0, 0.0, None, 0)
+    for i in range(n):
+        if best[i] is None:
+            continue
+        cuts, neg_quality = best[i][:2]
+        steps = runs[i].items() if runs[i] else [(1, (0.0, None))]
+        for length, (quality, *_) in steps:
+            candidate = (cuts + 1, neg_quality - quality, i, length)
+            if best[i + length] is None or candidate[:2] < best[i + length][:2]:
+                best[i + length] = candidate
+
+    plan = []
+    j = n
+    while j > 0:
+        i, length = best[j][2], best[j][3]
+        match = None
+        if runs[i]:
+            _, layer_no, pos = runs[i][length]
+            layer = index.layers[layer_no][0]
+            video_idx, start, end = layer.span(pos, length)
+            match = (layer.video_id(video_idx), start, end)
+        plan.append((i, j, match))
+        j = i
+    return plan[::-1]
 
 def search_sentence(sentence: str):
-    conn = sqlite3.connect(DB_PATH)
     """
     Searches for segments and words from the sentence in the database.
 
-    Prioritizes finding the largest matching segments first using FTS,
-    then falls back to individual words.
+    Covers the sentence with as few clips as possible, preferring runs of
+    words that were said back to back in one video (see `plan_sentence`).
 
     Args:
         sentence: The input sentence string.
@@ -49,165 +219,47 @@ def search_sentence(sentence: str):
         # Or return [] if empty input is acceptable without error
         raise ValueError("Input sentence cannot be empty.")
 
-    # 1. Preprocess the sentence: lowercase, strip punctuation, split
-    # Create a translation table to remove punctuation
-    translator = str.maketrans('', '', string.punctuation)
-    # Apply lowercase, strip leading/trailing whitespace, then remove punctuation
-    processed_sentence = sentence.strip().lower().translate(translator)
-    # Split into words and filter out empty strings
-    cleaned_words = [word for word in processed_sentence.split() if word]
-
+    cleaned_words = clean_sentence(sentence)
     if not cleaned_words:
         raise ValueError("Sentence contains no valid words after cleaning.")
 
     results = []
-    current_word_index = 0
-    c = conn.cursor()
-    num_words = len(cleaned_words)
-
-    while current_word_index < num_words:
-        found_match_in_iteration = False
-        # 2. Try to find the largest matching segment starting at current_word_index
-        # Iterate from the longest possible phrase down to a single word phrase
-        # (We check single words separately later if no multi-word segment matches)
-        for length in range(num_words - current_word_index, 0, -1):
-            end_index = current_word_index + length
-            phrase_words = cleaned_words[current_word_index:end_index]
-
-            # Should only search for segments if length > 1,
-            # but FTS might handle single words too. Let's keep it simple:
-            # search FTS for any length >= 1. If no segment is found,
-            # we'll specifically search the words table later.
-            if not phrase_words:
-                continue # Should not happen with loop logic
-
-            phrase_to_search = " ".join(phrase_words)
-            # Use FTS5 MATCH with double quotes for exact phrase search
-            # Note: FTS5 automatically handles tokenization based on spaces etc.
-            # Wrapping in quotes ensures the sequence is matched.
-            fts_query = f'"{phrase_to_search}"'
-
-            # print(f"DEBUG: Trying segment search for: {fts_query}") # Optional debug
-
-            try:
-                # Query the FTS table first
-                c.execute(
-                    """
-                    SELECT sfts.video_id, sfts.start, sfts.end, sfts.segment_text
-                    FROM segments_fts AS sfts
-                    WHERE sfts.segment_text MATCH ?
-                    LIMIT 1
-                    """,
-                    (fts_query,)
-                )
-                segment_match = c.fetchone()
-            except sqlite3.OperationalError as e:
-                 # Handle potential FTS query errors, e.g., malformed query
-                 print(f"Warning: FTS Query Error for '{fts_query}': {e}. Skipping phrase.")
-                 # Treat as no match found for this phrase length
-                 segment_match = None
-
-
-            if segment_match:
-                # print(f"DEBUG: Found segment: {segment_match}") # Optional debug
-                video_id, start, end, segment_text = segment_match
-                results.append({
-                    "type": "segment",
-                    "text": segment_text, # Use text from DB for correct representation
-                    "video_id": video_id,
-                    "start": start,
-                    "end": end
-                })
-                current_word_index = end_index # Move index past the found segment
-                found_match_in_iteration = True
-                break # Found the largest segment starting here, move to next part
-
-        # 3. If no segment (multi-word or single-word) was found via FTS starting at current_word_index
-        if not found_match_in_iteration:
-            word_to_search = cleaned_words[current_word_index]
-            # print(f"DEBUG: Trying word search for: {word_to_search}") # Optional debug
-
-            c.execute(
-                """
-                SELECT video_id, start, end, word
-                FROM words
-                WHERE word = ? COLLATE NOCASE -- Ensure case-insensitivity just in case
-                LIMIT 1
-                """,
-                (word_to_search,)
-            )
-            word_match = c.fetchone()
-
-            if word_match:
-                # print(f"DEBUG: Found word: {word_match}") # Optional debug
-                video_id, start, end, word_text = word_match
-                results.append({
-                    "type": "word",
-                    "text": word_text, # Use the text from DB
-                    "video_id": video_id,
-                    "start": start,
-                    "end": end
-                })
-                current_word_index += 1
-                found_match_in_iteration = True
-            else:
-                # 4. If neither segment nor word found, raise error
-                original_word = "???"
-                # Try to find the original word before cleaning (best effort)
-                # This requires tracking original words alongside cleaned ones,
-                # or re-parsing, which adds complexity. Let's just use the cleaned word for the error.
-                # A more robust solution might store original word mapping if needed.
-                raise Exception(f"Word '{word_to_search}' (from original sentence position {current_word_index+1}) not found in the database.")
-
+    for i, j, (video_id, start, end) in plan_sentence(cleaned_words):
+        results.append({
+            "type": "segment" if j - i > 1 else "word",
+            "text": " ".join(cleaned_words[i:j]),
+            "video_id": video_id,
+            "start": start,
+            "end": end
+        })
     return results
 
-def search_segments(sentence, db_path="new.db"):
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-
-    # Normalize sentence
-    normalized = sentence.strip().lower().translate(str.maketrans('', '', string.punctuation))
-
-    # We'll try finding the longest phrases first (split then rejoin)
-    words = normalized.split()
+def search_segments(sentence, db_path=DB_PATH):
+    index = _index_for(db_path)
+    words = clean_sentence(sentence)
     found_segments = []
-    used_indices = set()
-
-    # Try n-grams, longest first
-    for n in range(len(words), 0, -1):
-        for i in range(len(words) - n + 1):
-            if any(j in used_indices for j in range(i, i + n)):
-                continue  # already used in a longer match
-
-            phrase = ' '.join(words[i:i + n])
-            c.execute("""
-                SELECT video_id, start, end FROM segments_fts
-                WHERE segment_text MATCH ?
-                LIMIT 1
-            """, (phrase,))
-            row = c.fetchone()
-            if row:
-                found_segments.append({
-                    "phrase": phrase,
-                    "video_path": os.path.join(DOWNLOAD_DIR, f"{row[0]}.mp4"),
-                    "start": row[1],
-                    "end": row[2],
-                })
-                used_indices.update(range(i, i + n))
-
-    conn.close()
-    return found_segments, [w for i, w in enumerate(words) if i not in used_indices]
+    missing = []
+
+    for i, j, match in plan_sentence(words, index, allow_missing=True):
+        if match is None:
+            missing.append(words[i])
+            continue
+        video_id, start, end = match
+        found_segments.append({
+            "phrase": " ".join(words[i:j]),
+            "video_path": os.path.join(DOWNLOAD_DIR, f"{video_id}.mp4"),
+            "start": start,
+            "end": end,
+        })
+
+    return found_segments, missing
 
 def list_all_segments(db_path=DB_PATH):
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("""
+    rows = db.query("""
       SELECT id, video_id, segment_text, start, end
         FROM segments
        ORDER BY video_id, start
-    """)
-    rows = c.fetchall()
-    conn.close()
+    """, db_path=db_path)
     # pretty-print
     for seg_id, vid, text, s, e in rows:
         path = os.path.join(DOWNLOAD_DIR, f"{vid}.mp4")